@@ -1,28 +1,91 @@
 #! python
 import os
-from PIL import Image
+from PIL import Image, ImageSequence
 import pathlib
 import sys
 import argparse
 import colorsys
 import math
+import hashlib
+import glob
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from pixelart.color import hsv_to_rgb, rgb_to_hsv, rgb_to_lab, unique_colors
 
 test_img = pathlib.Path("E:\\pics\\reference\\trythis\\styleboard\\FF_tactics.png")
 _default_palette = pathlib.Path(__file__).parent.joinpath("old_windows_palette.png")
+_lut_dir = pathlib.Path.home().joinpath(".cache", "cool_cli_stuff", "palette_luts")
 
+# name -> metric class, filled in by register_metric
+metrics = {}
 
+
+def register_metric(metric):
+    """make a metric selectable by name
+    a metric has to_space to convert (N, 3) rgb into the space it measures in,
+    precompute for everything that only depends on the palette, and
+    batch_distance(palette, pixels, terms) for the (pixels, palette) distances,
+    where terms is what precompute returned. indexable metrics are a weighted
+    manhattan distance with palette_weights and can use a PaletteIndex, which is
+    built by itself for palettes of at least index_min_colors
+    """
+    metrics[metric.name] = metric
+    return metric
+
+
+@register_metric
 class rgba_distance:
+    name = "rgb"
+    indexable = True
+    # below this the vectorized brute force is faster than walking the tree
+    index_min_colors = 1024
+    weight_multipliers = [1, 1, 1]
+
     @classmethod
     def distance(cls, left, right):
         return sum([abs(left[i] - right[i]) for i in range(3)])
 
+    @classmethod
+    def to_space(cls, rgb):
+        return rgb
+
+    @classmethod
+    def signature(cls):
+        """anything besides the palette that changes the result, for cache keys"""
+        return b""
+
+    @classmethod
+    def palette_weights(cls, palette):
+        """per channel weight of each palette color, rgb channels are all equal"""
+        return np.ones((len(palette), 3))
+
+    @classmethod
+    def precompute(cls, palette):
+        return np.asarray(palette, dtype=np.int32)
+
+    @classmethod
+    def batch_distance(cls, palette, pixels, terms=None):
+        """distance from every pixel to every palette color as a (pixels, palette) array"""
+        palette = cls.precompute(palette) if terms is None else terms
+        pixels = np.asarray(pixels, dtype=np.int32)
+        total = np.zeros((len(pixels), len(palette)), dtype=np.int32)
+        for i in range(3):
+            total += np.abs(pixels[:, None, i] - palette[None, :, i])
+        return total
+
 
 # def rgba_distance(left, right):
 #     """return the distance between two colors"""
 #     return sum([abs(left[i] - right[i]) for i in range(3)])
 
 
+@register_metric
 class hsv_distance:
+    name = "hsv"
+    indexable = True
+    index_min_colors = 256
     max_wieght = 255
     min_weight = 0
 
@@ -78,6 +141,42 @@ class hsv_distance:
 
         return total_distance
 
+    @classmethod
+    def to_space(cls, rgb):
+        return rgb_to_hsv(rgb)
+
+    @classmethod
+    def signature(cls):
+        return repr(cls.weight_multipliers).encode()
+
+    @classmethod
+    def palette_weights(cls, palette):
+        """get_weights for each palette color as a (palette, 3) array"""
+        return np.array([cls.get_weights(color) for color in palette]).reshape(-1, 3)
+
+    @classmethod
+    def precompute(cls, palette):
+        """the palette as floats and its weights, get_weights is slow per color"""
+        return np.asarray(palette, dtype=np.float64), cls.palette_weights(palette)
+
+    @classmethod
+    def batch_distance(cls, palette, pixels, terms=None):
+        """distance from every pixel to every palette color as a (pixels, palette) array
+        adds the terms in the same order as distance() so ties break the same way
+        """
+        palette, weights = cls.precompute(palette) if terms is None else terms
+        pixels = np.asarray(pixels, dtype=np.float64)
+        total = np.zeros((len(pixels), len(palette)))
+        distances = np.empty_like(total)
+        for i in range(3):
+            np.subtract(palette[None, :, i], pixels[:, None, i], out=distances)
+            np.abs(distances, out=distances)
+            distances *= weights[None, :, i]
+            if cls.weight_multipliers[i] != 1:
+                distances *= cls.weight_multipliers[i]
+            total += distances
+        return total
+
     @classmethod
     def tests(cls):
         tests = {
@@ -99,44 +198,391 @@ class hsv_distance:
             )
 
 
+@register_metric
+class cie76_distance:
+    """euclidean distance in cielab"""
+
+    name = "cie76"
+    indexable = False
+
+    @classmethod
+    def distance(cls, left, right):
+        return math.dist(left[:3], right[:3])
+
+    @classmethod
+    def to_space(cls, rgb):
+        return rgb_to_lab(rgb)
+
+    @classmethod
+    def signature(cls):
+        return b""
+
+    @classmethod
+    def precompute(cls, palette):
+        return np.asarray(palette, dtype=np.float64)
+
+    @classmethod
+    def batch_distance(cls, palette, pixels, terms=None):
+        palette = cls.precompute(palette) if terms is None else terms
+        pixels = np.asarray(pixels, dtype=np.float64)
+        total = np.zeros((len(pixels), len(palette)))
+        distances = np.empty_like(total)
+        for i in range(3):
+            np.subtract(palette[None, :, i], pixels[:, None, i], out=distances)
+            distances *= distances
+            total += distances
+        return np.sqrt(total, out=total)
+
+
+@register_metric
+class ciede2000_distance:
+    """cie delta e 2000 in cielab, kL = kC = kH = 1"""
+
+    name = "ciede2000"
+    indexable = False
+
+    @classmethod
+    def distance(cls, left, right):
+        return float(cls.batch_distance([right], [left])[0, 0])
+
+    @classmethod
+    def to_space(cls, rgb):
+        return rgb_to_lab(rgb)
+
+    @classmethod
+    def signature(cls):
+        return b""
+
+    @classmethod
+    def precompute(cls, palette):
+        """L, a, b and chroma of each palette color, the rest depends on both colors"""
+        palette = np.asarray(palette, dtype=np.float64).reshape(-1, 3)
+        L, a, b = palette.T
+        return L, a, b, np.hypot(a, b)
+
+    @classmethod
+    def batch_distance(cls, palette, pixels, terms=None):
+        L2, a2, b2, C2 = cls.precompute(palette) if terms is None else terms
+        L1, a1, b1, C1 = (
+            channel[:, None] for channel in cls.precompute(pixels)
+        )
+        pow25_7 = 25.0**7
+        C_bar7 = ((C1 + C2) / 2) ** 7
+        G = 0.5 * (1 - np.sqrt(C_bar7 / (C_bar7 + pow25_7)))
+        a1p = (1 + G) * a1
+        a2p = (1 + G) * a2
+        C1p = np.hypot(a1p, b1)
+        C2p = np.hypot(a2p, b2)
+        h1p = np.arctan2(b1, a1p) % (2 * np.pi)
+        h2p = np.arctan2(b2, a2p) % (2 * np.pi)
+        chroma = C1p * C2p
+        gray = chroma == 0
+
+        dLp = L2 - L1
+        dCp = C2p - C1p
+        dhp = h2p - h1p
+        dhp = np.where(dhp > np.pi, dhp - 2 * np.pi, dhp)
+        dhp = np.where(dhp < -np.pi, dhp + 2 * np.pi, dhp)
+        dhp[gray] = 0
+        dHp = 2 * np.sqrt(chroma) * np.sin(dhp / 2)
+
+        L_bar = (L1 + L2) / 2
+        C_barp = (C1p + C2p) / 2
+        h_sum = h1p + h2p
+        h_barp = np.where(
+            np.abs(h1p - h2p) <= np.pi,
+            h_sum / 2,
+            np.where(h_sum < 2 * np.pi, (h_sum + 2 * np.pi) / 2, (h_sum - 2 * np.pi) / 2),
+        )
+        h_barp[gray] = h_sum[gray]
+
+        T = (
+            1
+            - 0.17 * np.cos(h_barp - np.radians(30))
+            + 0.24 * np.cos(2 * h_barp)
+            + 0.32 * np.cos(3 * h_barp + np.radians(6))
+            - 0.20 * np.cos(4 * h_barp - np.radians(63))
+        )
+        d_theta = np.radians(30) * np.exp(-(((np.degrees(h_barp) - 275) / 25) ** 2))
+        C_barp7 = C_barp**7
+        R_C = 2 * np.sqrt(C_barp7 / (C_barp7 + pow25_7))
+        L_50 = (L_bar - 50) ** 2
+        S_L = 1 + 0.015 * L_50 / np.sqrt(20 + L_50)
+        S_C = 1 + 0.045 * C_barp
+        S_H = 1 + 0.015 * C_barp * T
+        R_T = -np.sin(2 * d_theta) * R_C
+
+        dL = dLp / S_L
+        dC = dCp / S_C
+        dH = dHp / S_H
+        return np.sqrt(dL * dL + dC * dC + dH * dH + R_T * dC * dH)
+
+
+class PaletteIndex:
+    """k-d tree over the palette for nearest color queries
+
+    the indexable metrics are a weighted manhattan distance where the weights come
+    from the palette color (all 1 for rgb, hsv_distance.get_weights for hsv).
+    every node keeps its bounding box and the smallest weights below it,
+    which bounds the distance to anything in the subtree from below so whole
+    subtrees can be skipped. ties go to the lowest palette index, same as
+    the linear search in PaletteApplier.find_nearest_color
+    """
+
+    leaf_size = 32
+
+    def __init__(self, palette, metric=rgba_distance):
+        self.palette = np.asarray(palette, dtype=np.float64)
+        self.metric = metric
+        self.weights = metric.palette_weights(self.palette)
+        self.multipliers = list(metric.weight_multipliers)
+        self._points = self.palette.tolist()
+        self._weights = self.weights.tolist()
+        self.leaves = []
+        self.root = self._build(np.arange(len(self.palette)))
+        # node id -> (lo, hi, min_weights x multipliers) arrays for query_batch
+        self._bounds = {}
+
+    def _build(self, indices):
+        """nodes are (lo, hi, min_weights, children, palette_indices)"""
+        points = self.palette[indices]
+        lo = points.min(axis=0)
+        hi = points.max(axis=0)
+        min_weights = self.weights[indices].min(axis=0)
+        spread = (hi - lo) * self.weights[indices].max(axis=0) * self.multipliers
+        if len(indices) <= self.leaf_size or not spread.any():
+            leaf = (lo.tolist(), hi.tolist(), min_weights.tolist(), None, indices)
+            self.leaves.append(leaf)
+            return leaf
+        axis = spread.argmax()
+        order = indices[np.argsort(points[:, axis], kind="stable")]
+        half = len(order) // 2
+        children = (self._build(np.sort(order[:half])), self._build(np.sort(order[half:])))
+        return (lo.tolist(), hi.tolist(), min_weights.tolist(), children, indices)
+
+    def query(self, color):
+        """return the index of the palette color nearest to a single color"""
+        color = [float(num) for num in color[:3]]
+        best = [math.inf, -1]
+        self._visit(self.root, color, best)
+        return best[1]
+
+    def _visit(self, node, color, best):
+        lo, hi, min_weights, children, indices = node
+        if self._lower_bound(lo, hi, min_weights, color) > best[0]:
+            return
+        if children is None:
+            for i in indices.tolist():
+                distance = self._distance(i, color)
+                if distance < best[0] or (distance == best[0] and i < best[1]):
+                    best[0], best[1] = distance, i
+            return
+        near, far = children
+        if self._lower_bound(*far[:3], color) < self._lower_bound(*near[:3], color):
+            near, far = far, near
+        self._visit(near, color, best)
+        self._visit(far, color, best)
+
+    def _distance(self, i, color):
+        point = self._points[i]
+        weights = self._weights[i]
+        total = 0
+        for axis in range(3):
+            total += abs(point[axis] - color[axis]) * weights[axis] * self.multipliers[axis]
+        return total
+
+    def _lower_bound(self, lo, hi, min_weights, color):
+        total = 0
+        for axis in range(3):
+            gap = max(lo[axis] - color[axis], color[axis] - hi[axis], 0.0)
+            total += gap * min_weights[axis] * self.multipliers[axis]
+        return total
+
+    def query_batch(self, colors):
+        """return the index of the nearest palette color for each row of an (N, 3) array
+        all the colors walk down the tree together, at every node each color goes to
+        its nearer child first and drops out of subtrees that can't beat its best,
+        so a color only visits the few nodes around it
+        """
+        colors = np.asarray(colors, dtype=np.float64)[:, :3]
+        best = np.full(len(colors), np.inf)
+        best_index = np.full(len(colors), -1, dtype=np.intp)
+        rows = np.arange(len(colors))
+        self._visit_batch(
+            self.root, colors, rows, np.zeros(len(rows)), best, best_index
+        )
+        return best_index
+
+    def _visit_batch(self, node, colors, rows, bounds, best, best_index):
+        """colors are the rows' colors, bounds their lower bounds to node"""
+        # equal bounds are still searched, the subtree may hold a lower index tie
+        keep = bounds <= best[rows]
+        if not keep.all():
+            rows, colors = rows[keep], colors[keep]
+        if not len(rows):
+            return
+        children = node[3]
+        if children is None:
+            self._search_leaf(node, colors, rows, best, best_index)
+            return
+        left, right = children
+        left_bounds = self._lower_bounds(left, colors)
+        right_bounds = self._lower_bounds(right, colors)
+        near = left_bounds <= right_bounds
+        far = ~near
+        for child, child_bounds, side in (
+            (left, left_bounds, near),
+            (right, right_bounds, far),
+            (right, right_bounds, near),
+            (left, left_bounds, far),
+        ):
+            self._visit_batch(
+                child, colors[side], rows[side], child_bounds[side], best, best_index
+            )
+
+    def _lower_bounds(self, node, colors):
+        bounds = self._bounds.get(id(node))
+        if bounds is None:
+            lo, hi, min_weights = (np.array(values) for values in node[:3])
+            bounds = (lo, hi, min_weights * self.multipliers)
+            self._bounds[id(node)] = bounds
+        lo, hi, scale = bounds
+        gaps = np.maximum(lo - colors, colors - hi)
+        np.maximum(gaps, 0.0, out=gaps)
+        return gaps @ scale
+
+    def _search_leaf(self, leaf, colors, rows, best, best_index):
+        indices = leaf[4]
+        points = self.palette[indices]
+        weights = self.weights[indices]
+        total = np.zeros((len(rows), len(indices)))
+        for axis in range(3):
+            distances = np.abs(points[None, :, axis] - colors[:, None, axis])
+            distances *= weights[None, :, axis]
+            if self.multipliers[axis] != 1:
+                distances *= self.multipliers[axis]
+            total += distances
+        nearest = total.argmin(axis=1)
+        distance = total[np.arange(len(rows)), nearest]
+        nearest = indices[nearest]
+        better = (distance < best[rows]) | (
+            (distance == best[rows]) & (nearest < best_index[rows])
+        )
+        best[rows[better]] = distance[better]
+        best_index[rows[better]] = nearest[better]
+
+
 class PaletteApplier:
-    def __init__(self, palette, image, output=None, using_hsv=False, normalize=False):
-        self.using_hsv = True  # using_hsv
+    # upper bound on pixel x palette distances held in memory at once
+    chunk_size = 1 << 18
+    # palettes at least this big get a PaletteIndex even if none was asked for,
+    # None leaves it to the metric's index_min_colors
+    index_min_colors = None
+    # match only the unique colors and scatter them back when the pixels have at
+    # least this many pixels per color
+    unique_ratio = 4
+
+    def __init__(
+        self,
+        palette,
+        image,
+        output=None,
+        using_hsv=True,
+        normalize=False,
+        lut_bits=None,
+        index=None,
+        workers=1,
+        metric=None,
+    ):
+        # a metric name from metrics, using_hsv is the same as metric="hsv"
+        self.metric_name = metric or ("hsv" if using_hsv else "rgb")
         self.palette = palette
         self.colors = []
         self.hsv_palette = []
         self.image_path = image
         self.image = None
-        self.output = (
-            output
-            if output is not None
-            else self.new_image_file_path(self.palette, self.image_path, self.using_hsv)
-        )
+        self.output = output
+        if self.output is None and self.image_path is not None:
+            self.output = self.new_image_file_path(
+                self.palette, self.image_path, self.metric_name
+            )
         self.hash_table = {}
+        # (metric name, match palette, output rgb, precomputed terms), see _palette_arrays
+        self.palette_cache = None
+        # packed rgb -> palette index, sorted by key and shared by every frame mapped
+        self.cache_keys = np.empty(0, dtype=np.uint32)
+        self.cache_values = np.empty(0, dtype=np.intp)
+        self.cache_hits = 0
+        self.cache_lookups = 0
+        self.frames = None
+        self.frame_info = []
+        self.loop = 0
+        self.lut_bits = lut_bits
+        self.lut = None
+        self.lut_path = None
+        self.index = index
+        self.workers = workers
 
         self.num_px = 0
         self.i_px = 0
         self.percent_complete = 0
+        self.show_progress = True
 
         self.hsv_image = None
 
-    def new_image_file_path(self, palette, image, using_hsv=False):
+    @property
+    def metric(self):
+        return metrics[self.metric_name]
+
+    @property
+    def using_hsv(self):
+        return self.metric_name == "hsv"
+
+    @using_hsv.setter
+    def using_hsv(self, using_hsv):
+        self.metric_name = "hsv" if using_hsv else "rgb"
+
+    def new_image_file_path(self, palette, image, metric="rgb"):
         """return a new file path for the image
-        new name is the image name + _ + palette name
+        new name is the image name + _ + palette name (+ _ + metric unless rgb)
         in the same directory as the image
         """
         palette_ = pathlib.Path(palette)
         image_ = pathlib.Path(image)
-        hsv_string = "_hsv" if using_hsv else ""
-        new_name = image_.stem + "_" + palette_.stem + hsv_string + image_.suffix
+        metric_string = f"_{metric}" if metric != "rgb" else ""
+        new_name = image_.stem + "_" + palette_.stem + metric_string + image_.suffix
         return image_.parent.joinpath(new_name)
 
     def main(self, *args, **kwargs):
         """main function"""
+        self.prepare()
+        self._load_image()
+        self.apply_palette()
+        self.save_image()
+
+    def prepare(self):
+        """load the palette and build whatever makes matching against it fast"""
         self._load_palette(self.palette)
+        min_colors = self.index_min_colors
+        if min_colors is None:
+            min_colors = getattr(self.metric, "index_min_colors", math.inf)
+        if len(self.colors) >= min_colors:
+            self.build_index()
+        if self.lut_bits:
+            self.compile_palette(self.lut_bits)
+
+    def apply_to(self, image_path, output=None):
+        """map another image with the already prepared palette, returns its pixel count"""
+        self.image_path = image_path
+        self.output = output or self.new_image_file_path(
+            self.palette, image_path, self.metric_name
+        )
+        self.i_px = 0
+        self.percent_complete = 0
         self._load_image()
         self.apply_palette()
         self.save_image()
+        return self.image.width * self.image.height * len(self.frames or [self.image])
 
     def get_path(self, path):
         """get the path to the file"""
@@ -145,41 +591,380 @@ class PaletteApplier:
     def _load_palette(self, image_arg):
         """open image file to rgba list"""
         with Image.open(image_arg) as image_obj:
-            for x in range(0, image_obj.width):
-                for y in range(0, image_obj.height):
-                    pixel = image_obj.getpixel((x, y))
-
-                    if pixel[3] == 0:
-                        continue
-                    new_pixel = (pixel[0], pixel[1], pixel[2], 255)
-                    new_hsv = colorsys.rgb_to_hsv(pixel[0], pixel[1], pixel[2])
-                    if new_pixel not in self.colors:
-                        self.colors.append(new_pixel)
-                    if new_hsv not in self.hsv_palette:
-                        self.hsv_palette.append(new_hsv)
+            colors = unique_colors(image_obj)
+        self.colors = [(r, g, b, 255) for r, g, b in colors.tolist()]
+        self.hsv_palette = list(dict.fromkeys(map(tuple, rgb_to_hsv(colors).tolist())))
+        self.cache_keys = np.empty(0, dtype=np.uint32)
+        self.cache_values = np.empty(0, dtype=np.intp)
+        self.palette_cache = None
 
     def _load_image(self):
-        """open image as rgba mode image"""
+        """open image as rgba mode image, every frame of animated gifs and pngs"""
         with Image.open(self.image_path) as image_obj:
-            self.image = image_obj.convert("RGBA")
+            self.frames = None
+            self.frame_info = []
+            if getattr(image_obj, "is_animated", False):
+                self._load_frames(image_obj)
+                self.image = self.frames[0]
+            else:
+                self.image = image_obj.convert("RGBA")
             # self.hsv_image = image_obj.convert("HSV")
             self.num_px = self.image.width * self.image.height
 
+    def _load_frames(self, image_obj):
+        """decode every frame to a full rgba image and keep what's needed to encode it again"""
+        self.frames = []
+        self.frame_info = []
+        self.loop = image_obj.info.get("loop", 0)
+        for frame in ImageSequence.Iterator(image_obj):
+            self.frames.append(frame.convert("RGBA"))
+            # gif keeps the disposal on the image, apng in the frame info
+            disposal = getattr(frame, "disposal_method", frame.info.get("disposal", 0))
+            self.frame_info.append(
+                {"duration": frame.info.get("duration", 0), "disposal": disposal}
+            )
+
     def apply_palette(self):
-        """iterate over the image and replace each pixel with the nearest color in the palette"""
-        for y in range(self.image.height):
-            for x in range(self.image.width):
-                pixel = self.image.getpixel((x, y))
+        """replace each opaque pixel with the nearest color in the palette
+        pixels are matched in chunks against the whole palette at once
+        """
+        if self.frames is not None:
+            self._apply_palette_frames()
+            return
+        if self.workers > 1 and self.image.height > 1:
+            self._apply_palette_parallel()
+            return
+        pixels = np.array(self.image)
+        self.num_px = np.count_nonzero(pixels[:, :, 3])
+        self.map_pixels(pixels)
+        self.image = Image.fromarray(pixels, "RGBA")
+
+    def map_pixels(self, pixels, progress=True):
+        """map an (h, w, 4) rgba array in place, returns the number of opaque pixels"""
+        flat = pixels.reshape(-1, 4)
+        opaque = np.flatnonzero(flat[:, 3])
+        palette_rgb = self._palette_arrays()[1]
+        if self.lut is not None:
+            flat[opaque, :3] = palette_rgb[self.lut_lookup(flat[opaque, :3])]
+            if progress:
+                self.update_percent(len(opaque))
+        elif self.few_colors(flat[opaque, :3]):
+            flat[opaque, :3] = palette_rgb[self.cached_indices(flat[opaque, :3])]
+            if progress:
+                self.update_percent(len(opaque))
+        else:
+            nearest = self.nearest_indices(flat[opaque, :3], progress)
+            flat[opaque, :3] = palette_rgb[nearest]
+        return len(opaque)
+
+    def few_colors(self, rgb):
+        """whether rgb has far fewer unique colors than rows
+        the output only depends on the colors, so then it's cheaper to match each once.
+        the colors are counted exactly, a sample sees far fewer repeats than the image
+        has and only a few hundred colors would pass
+        """
+        if not len(rgb):
+            return False
+        packed = np.sort(
+            rgb.astype(np.uint32) @ np.array([1 << 16, 1 << 8, 1], dtype=np.uint32)
+        )
+        num_colors = np.count_nonzero(packed[1:] != packed[:-1]) + 1
+        return num_colors * self.unique_ratio <= len(rgb)
+
+    def preview(self, budget=0.5):
+        """map a copy of the image scaled down so matching fits in about budget seconds
+        when the image has few enough colors the preview is the full result
+        colors matched here stay in the cache, so mapping the full image after is cheaper
+        returns the preview and the scale it was mapped at
+        """
+        start = time.perf_counter()
+        pixels = np.array(self.image)
+        flat = pixels.reshape(-1, 4)
+        opaque = np.flatnonzero(flat[:, 3])
+        rgb = flat[opaque, :3]
+        # time a probe of the image's own colors to see how many can be matched in time
+        probe = rgb[:: max(1, len(rgb) // 1024)]
+        probe_start = time.perf_counter()
+        self.nearest_indices(probe, progress=False)
+        rate = len(probe) / max(time.perf_counter() - probe_start, 1e-6)
+        affordable = rate * max(budget - (time.perf_counter() - start), 0)
+
+        packed = np.sort(
+            rgb.astype(np.uint32) @ np.array([1 << 16, 1 << 8, 1], dtype=np.uint32)
+        )
+        # counted from the sorted values, np.unique hashes and is slow with many colors
+        num_colors = np.count_nonzero(packed[1:] != packed[:-1]) + 1
+        if num_colors <= affordable:
+            flat[opaque, :3] = self._palette_arrays()[1][self.cached_indices(rgb)]
+            return Image.fromarray(pixels, "RGBA"), 1
+
+        width, height = self.image.size
+        scale = max(2, math.ceil(math.sqrt(len(rgb) / max(affordable, 1))))
+        small = self.image.resize(
+            (max(1, width // scale), max(1, height // scale)), Image.NEAREST
+        )
+        pixels = np.array(small)
+        self.map_pixels(pixels, progress=False)
+        return Image.fromarray(pixels, "RGBA").resize((width, height), Image.NEAREST), scale
+
+    def save_preview(self, budget=0.5):
+        """write the preview next to the output as <output>_preview"""
+        start = time.perf_counter()
+        preview, scale = self.preview(budget)
+        output = pathlib.Path(self.output)
+        preview_path = output.with_name(f"{output.stem}_preview{output.suffix}")
+        preview.save(preview_path)
+        print(
+            f"preview at 1/{scale} scale in {time.perf_counter() - start:.2f}s"
+            f" -> {preview_path}"
+        )
+        return preview_path
+
+    def _apply_palette_frames(self):
+        """map every frame of an animation through one shared color cache
+        frames mostly reuse the same colors, so after the first few frames nearly
+        every color is already cached and a frame costs a lookup and a scatter;
+        with workers the colors missing from the cache are matched in a process pool
+        """
+        self.num_px = len(self.frames)
+        pool = None
+        if self.workers > 1 and self.lut is None:
+            pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_batch_worker,
+                initargs=(self,),
+            )
+        palette_rgb = self._palette_arrays()[1]
+        # gif frames are written as palette images, letting the encoder quantize the
+        # rgba frames again can shift colors and drop transparency on later frames
+        indexed = (
+            pathlib.Path(self.output).suffix.lower() == ".gif" and len(palette_rgb) < 256
+        )
+        try:
+            for i, frame in enumerate(self.frames):
+                pixels = np.array(frame)
+                flat = pixels.reshape(-1, 4)
+                opaque = np.flatnonzero(flat[:, 3])
+                if self.lut is not None:
+                    nearest = self.lut_lookup(flat[opaque, :3])
+                else:
+                    nearest = self.cached_indices(flat[opaque, :3], pool)
+                if indexed:
+                    self.frames[i] = self._indexed_frame(
+                        frame.size, opaque, nearest, palette_rgb
+                    )
+                else:
+                    flat[opaque, :3] = palette_rgb[nearest]
+                    self.frames[i] = Image.fromarray(pixels, "RGBA")
                 self.update_percent()
-                if pixel[3] == 0:
-                    continue
-                # hsv_pixel = self.hsv_image.getpixel((x, y))
-                new_color = self.find_nearest_color(pixel)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        self.image = self.frames[0]
+        if self.show_progress and self.cache_lookups:
+            print(
+                f"{len(self.frames)} frames, {len(self.cache_keys)} colors matched,"
+                f" {self.cache_hits / self.cache_lookups:.1%} cache hits"
+            )
+
+    def _indexed_frame(self, size, opaque, nearest, palette_rgb):
+        """a palette mode frame, the entry after the palette colors is transparent"""
+        transparent = len(palette_rgb)
+        indices = np.full(size[0] * size[1], transparent, dtype=np.uint8)
+        indices[opaque] = nearest
+        frame = Image.frombytes("P", size, indices.tobytes())
+        frame.putpalette(palette_rgb.tobytes() + bytes(3))
+        frame.info["transparency"] = transparent
+        return frame
+
+    def cached_indices(self, rgb, pool=None):
+        """nearest_indices through the color cache, only colors never seen before are matched
+        pool is an optional executor set up by _init_batch_worker to match them in
+        """
+        packed = rgb.astype(np.uint32) @ np.array([1 << 16, 1 << 8, 1], dtype=np.uint32)
+        keys, inverse = np.unique(packed, return_inverse=True)
+        found = np.searchsorted(self.cache_keys, keys)
+        found[found == len(self.cache_keys)] = 0
+        hit = (
+            self.cache_keys[found] == keys
+            if len(self.cache_keys)
+            else np.zeros(len(keys), dtype=bool)
+        )
+        self.cache_hits += int(np.count_nonzero(hit))
+        self.cache_lookups += len(keys)
+
+        values = np.empty(len(keys), dtype=np.intp)
+        values[hit] = self.cache_values[found[hit]]
+        missing = keys[~hit]
+        if len(missing):
+            missing_rgb = np.empty((len(missing), 3), dtype=np.uint8)
+            missing_rgb[:, 0] = missing >> 16
+            missing_rgb[:, 1] = missing >> 8
+            missing_rgb[:, 2] = missing
+            if pool is not None and len(missing) >= self.chunk_size // len(self.colors):
+                step = -(-len(missing) // (self.workers * 4))
+                chunks = [
+                    missing_rgb[start : start + step]
+                    for start in range(0, len(missing), step)
+                ]
+                new_values = np.concatenate(list(pool.map(_batch_nearest, chunks)))
+            else:
+                new_values = self.nearest_indices(missing_rgb, progress=False)
+            values[~hit] = new_values
+            order = np.argsort(np.concatenate([self.cache_keys, missing]))
+            self.cache_keys = np.concatenate([self.cache_keys, missing])[order]
+            self.cache_values = np.concatenate([self.cache_values, new_values])[order]
+        return values[inverse.ravel()]
+
+    def _apply_palette_parallel(self):
+        """split the image into row bands and map them in a process pool
+        the pixels live in shared memory and every worker maps its band in place,
+        so nothing but row numbers goes through pickling
+        """
+        width, height = self.image.size
+        shm = shared_memory.SharedMemory(create=True, size=width * height * 4)
+        try:
+            pixels = np.ndarray((height, width, 4), dtype=np.uint8, buffer=shm.buf)
+            pixels[:] = np.asarray(self.image)
+            self.num_px = np.count_nonzero(pixels[:, :, 3])
+            # a few bands per worker so a slow band doesn't hold up the rest
+            bounds = np.linspace(0, height, min(height, self.workers * 4) + 1, dtype=int)
+            with ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_band_worker,
+                initargs=(self, shm.name, pixels.shape),
+            ) as pool:
+                jobs = [
+                    pool.submit(_map_band, int(start), int(stop))
+                    for start, stop in zip(bounds[:-1], bounds[1:])
+                ]
+                for job in as_completed(jobs):
+                    self.update_percent(job.result())
+            self.image = Image.frombytes("RGBA", (width, height), pixels)
+            del pixels
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def __getstate__(self):
+        """workers only need the palette side, the lut is mapped again from its file"""
+        state = self.__dict__.copy()
+        state.update(image=None, hsv_image=None, lut=None, hash_table={}, frames=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.lut_path is not None:
+            self.lut = np.load(self.lut_path, mmap_mode="r")
 
-                self.image.putpixel((x, y), new_color)
+    def build_index(self):
+        """build a PaletteIndex for this palette and metric unless one was passed in
+        the index can be handed to other PaletteApplier instances for the same palette
+        """
+        if self.index is None and self.metric.indexable:
+            self.index = PaletteIndex(self._palette_arrays()[0], self.metric)
+        return self.index
+
+    def nearest_indices(self, rgb, progress=True):
+        """return the index of the nearest palette entry for each row of an (N, 3) rgb array
+        pixels are matched in chunks against the whole palette at once
+        """
+        palette = self._palette_arrays()[0]
+        terms = self.palette_terms()
+        metric = self.metric
+        nearest = np.empty(len(rgb), dtype=np.intp)
+        # the index only holds rows x leaf_size distances, but walks the tree once
+        # per chunk, so it takes bigger chunks
+        columns = len(palette) if self.index is None else self.index.leaf_size // 8
+        step = max(1, self.chunk_size // columns)
+        for start in range(0, len(rgb), step):
+            chunk = metric.to_space(rgb[start : start + step])
+            if self.index is not None:
+                nearest[start : start + step] = self.index.query_batch(chunk)
+            else:
+                nearest[start : start + step] = metric.batch_distance(
+                    palette, chunk, terms
+                ).argmin(axis=1)
+            if progress:
+                self.update_percent(len(chunk))
+        return nearest
 
-    def update_percent(self):
-        self.i_px += 1
+    def compile_palette(self, bits=8):
+        """load the lookup table for this palette and metric, building it if it isn't cached
+        the table maps every rgb value, quantized to the given bits per channel,
+        to the index of its nearest palette entry
+        """
+        lut_path = self._lut_path(bits)
+        if not lut_path.exists():
+            print(f"compiling {pathlib.Path(self.palette).name} to {lut_path}")
+            lut = self._build_lut(bits)
+            lut_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = lut_path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as lut_file:
+                np.save(lut_file, lut)
+            os.replace(tmp_path, lut_path)
+        self.lut_bits = bits
+        self.lut_path = lut_path
+        self.lut = np.load(lut_path, mmap_mode="r")
+        return self.lut
+
+    def lut_lookup(self, rgb):
+        """return the palette index for each row of an (N, 3) rgb array using the lut"""
+        shift = 8 - self.lut_bits
+        rgb = np.asarray(rgb) >> shift
+        return self.lut[rgb[:, 0], rgb[:, 1], rgb[:, 2]]
+
+    def _lut_path(self, bits):
+        """the lut file is keyed by the palette content, the metric and the quantization"""
+        with open(self.palette, "rb") as palette_file:
+            key = hashlib.sha256(palette_file.read())
+        key.update(self.metric.signature())
+        return _lut_dir.joinpath(
+            f"{key.hexdigest()[:32]}_{self.metric_name}_{bits}.npy"
+        )
+
+    def _build_lut(self, bits):
+        """match the center of every quantized rgb cell against the palette"""
+        size = 1 << bits
+        shift = 8 - bits
+        levels = (np.arange(size, dtype=np.uint16) << shift) + ((1 << shift) >> 1)
+        dtype = np.uint8 if len(self.colors) <= 256 else np.uint16
+        lut = np.empty((size, size, size), dtype=dtype)
+        g, b = np.meshgrid(levels, levels, indexing="ij")
+        plane = np.empty((size * size, 3), dtype=np.uint8)
+        plane[:, 1] = g.ravel()
+        plane[:, 2] = b.ravel()
+        for r in range(size):
+            plane[:, 0] = levels[r]
+            lut[r] = self.nearest_indices(plane, progress=False).reshape(size, size)
+        return lut
+
+    def _palette_arrays(self):
+        """return the palette to match against and the rgb value each entry maps to
+        they only change with the palette or the metric, so they're kept until then
+        along with the metric's precomputed terms
+        """
+        if self.palette_cache is None or self.palette_cache[0] != self.metric_name:
+            if self.using_hsv:
+                palette = np.array(self.hsv_palette).reshape(-1, 3)
+                rgb = np.floor(hsv_to_rgb(palette)).astype(np.uint8)
+            else:
+                rgb = np.array(self.colors, dtype=np.uint8).reshape(-1, 4)[:, :3]
+                palette = self.metric.to_space(rgb)
+            terms = self.metric.precompute(palette)
+            self.palette_cache = (self.metric_name, palette, rgb, terms)
+        return self.palette_cache[1:3]
+
+    def palette_terms(self):
+        """what the metric precomputed for this palette, shared by every chunk and image"""
+        self._palette_arrays()
+        return self.palette_cache[3]
+
+    def update_percent(self, num_px=1):
+        # a fully transparent image has nothing to map
+        if not self.show_progress or not self.num_px:
+            return
+        self.i_px += num_px
         new_percent_complete = int(self.i_px / self.num_px * 100)
         if new_percent_complete > self.percent_complete:
             self.percent_complete = new_percent_complete
@@ -190,16 +975,39 @@ class PaletteApplier:
         """save the new_image to the output path"""
         if not self.output:
             self.output = self.new_image_file_path(
-                self.palette, self.image_path, self.using_hsv
+                self.palette, self.image_path, self.metric_name
             )
-        self.image.save(self.output)
+        if self.frames is None:
+            self.image.save(self.output)
+            return
+        save_args = {}
+        if pathlib.Path(self.output).suffix.lower() == ".png":
+            # every frame is a full image, replace the last one instead of drawing over it
+            save_args["blend"] = 0
+        elif self.frames[0].mode == "P":
+            # optimizing renumbers the palette and loses the transparent entry
+            save_args["optimize"] = False
+        self.frames[0].save(
+            self.output,
+            save_all=True,
+            append_images=self.frames[1:],
+            duration=[info["duration"] for info in self.frame_info],
+            disposal=[info["disposal"] for info in self.frame_info],
+            loop=self.loop,
+            **save_args,
+        )
 
     def find_nearest_color(self, color):
         """find the nearest color in the palette to the given color
         high or low brightness devalue the hue weight
         low saturation devalues the hue weight
         """
-        this_color = color if not self.using_hsv else colorsys.rgb_to_hsv(*color[:3])
+        if self.metric_name == "rgb":
+            this_color = color
+        elif self.using_hsv:
+            this_color = colorsys.rgb_to_hsv(*color[:3])
+        else:
+            this_color = tuple(self.metric.to_space(np.array(color[:3])).tolist())
 
         if this_color in self.hash_table.keys():
             nearest_color = self.hash_table[this_color]
@@ -208,29 +1016,168 @@ class PaletteApplier:
             )
 
         this_palette = self.hsv_palette if self.using_hsv else self.colors
-        color_distance_func = (
-            rgba_distance.distance if not self.using_hsv else hsv_distance.distance
-        )
+        if self.metric_name not in ("rgb", "hsv"):
+            this_palette = self._palette_arrays()[0].tolist()
+        if self.index is not None:
+            nearest = self.index.query(this_color)
+        else:
+            nearest = self._linear_nearest(this_palette, this_color)
+        nearest_color = this_palette[nearest]
+
+        # convert back to rgba if needed
+        if self.using_hsv:
+            nearest_color = colorsys.hsv_to_rgb(*nearest_color)
+        elif self.metric_name != "rgb":
+            nearest_color = self.colors[nearest]
+        nearest_color = [math.floor(num) for num in nearest_color]
+
+        self.hash_table[this_color] = nearest_color
+        return tuple([nearest_color[0], nearest_color[1], nearest_color[2], color[3]])
+
+    def _linear_nearest(self, this_palette, this_color):
+        """compare against every palette color in order, returns the index of the nearest"""
+        color_distance_func = self.metric.distance
 
         # find the color in the palette with the lowest distance
-        nearest_color = this_palette[0]
-        nearest_distance = color_distance_func(nearest_color, this_color)
+        nearest = 0
+        nearest_distance = color_distance_func(this_palette[0], this_color)
 
         for i in range(1, len(this_palette)):
-            palette_color = this_palette[i]
-            distance = color_distance_func(palette_color, this_color)
+            distance = color_distance_func(this_palette[i], this_color)
             if distance < nearest_distance:
-                nearest_color = palette_color
+                nearest = i
                 nearest_distance = distance
+        return nearest
 
-        # convert back to rgba if needed
-        nearest_color = (
-            nearest_color if not self.using_hsv else colorsys.hsv_to_rgb(*nearest_color)
+
+class PaletteBatch:
+    """apply one palette to every image matched by a list of directories and globs
+    the palette is loaded and indexed once and every worker gets a copy of it
+    """
+
+    image_suffixes = {".png", ".gif", ".bmp", ".tga", ".webp"}
+
+    def __init__(self, applier, inputs, workers=1):
+        self.applier = applier
+        self.inputs = inputs
+        self.workers = workers
+
+    def main(self):
+        self.applier.prepare()
+        self.applier.workers = 1
+        self.applier.show_progress = False
+        todo, num_skipped = self.collect()
+
+        num_images = 0
+        num_px = 0
+        num_failed = 0
+        start = time.perf_counter()
+        for image_path, result in self.run(todo):
+            if isinstance(result, Exception):
+                num_failed += 1
+                print(f"failed {image_path}: {result}")
+            else:
+                num_images += 1
+                num_px += result
+        elapsed = max(time.perf_counter() - start, 1e-9)
+
+        print(
+            f"{num_images} images in {elapsed:.2f}s"
+            f" ({num_skipped} up to date, {num_failed} failed)"
         )
-        nearest_color = [math.floor(num) for num in nearest_color]
+        print(f"{num_images / elapsed:.2f} images/s, {num_px / elapsed:,.0f} px/s")
+
+    def collect(self):
+        """return the (image, output) pairs that need mapping and how many are up to date"""
+        # outputs of earlier runs match the same globs, leave them alone
+        output_tag = self.applier.new_image_file_path(
+            self.applier.palette, "_.png", self.applier.metric_name
+        ).stem[1:]
+        palette_mtime = os.path.getmtime(self.applier.palette)
+
+        paths = []
+        for pattern in self.inputs:
+            if os.path.isdir(pattern):
+                matches = sorted(pathlib.Path(pattern).iterdir())
+            else:
+                matches = [pathlib.Path(match) for match in sorted(glob.glob(pattern))]
+            paths.extend(
+                path
+                for path in matches
+                if path.suffix.lower() in self.image_suffixes
+                and path.is_file()
+                and not path.stem.endswith(output_tag)
+            )
+
+        todo = []
+        num_skipped = 0
+        for path in dict.fromkeys(paths):
+            output = self.applier.new_image_file_path(
+                self.applier.palette, path, self.applier.metric_name
+            )
+            newest_input = max(path.stat().st_mtime, palette_mtime)
+            if output.exists() and output.stat().st_mtime >= newest_input:
+                num_skipped += 1
+            else:
+                todo.append((path, output))
+        return todo, num_skipped
+
+    def run(self, todo):
+        """yield (image, pixel count or the exception it failed with) as images finish"""
+        if self.workers <= 1:
+            for image_path, output in todo:
+                try:
+                    yield image_path, self.applier.apply_to(image_path, output)
+                except Exception as err:
+                    yield image_path, err
+            return
+
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_batch_worker,
+            initargs=(self.applier,),
+        ) as pool:
+            jobs = {
+                pool.submit(_batch_apply, image_path, output): image_path
+                for image_path, output in todo
+            }
+            for job in as_completed(jobs):
+                try:
+                    yield jobs[job], job.result()
+                except Exception as err:
+                    yield jobs[job], err
+
+
+_batch_worker = {}
+
+
+def _init_batch_worker(applier):
+    _batch_worker["applier"] = applier
+
+
+def _batch_apply(image_path, output):
+    return _batch_worker["applier"].apply_to(image_path, output)
+
+
+def _batch_nearest(rgb):
+    return _batch_worker["applier"].nearest_indices(rgb, progress=False)
+
+
+_band_worker = {}
+
+
+def _init_band_worker(applier, shm_name, shape):
+    """attach a pool worker to the shared pixel buffer"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _band_worker["applier"] = applier
+    _band_worker["shm"] = shm
+    _band_worker["pixels"] = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
 
-        self.hash_table[this_color] = nearest_color
-        return tuple([nearest_color[0], nearest_color[1], nearest_color[2], color[3]])
+
+def _map_band(start, stop):
+    """map rows start:stop of the shared image in place"""
+    band = _band_worker["pixels"][start:stop]
+    return _band_worker["applier"].map_pixels(band, progress=False)
 
 
 def parse_args(args_):
@@ -246,7 +1193,20 @@ def parse_args(args_):
         help="image path to apply palette to",
     )
     parser.add_argument(
-        "-v", "--hsv", default=False, action="store_true", help="use hsv instead of rgb"
+        "-v",
+        "--hsv",
+        dest="metric",
+        action="store_const",
+        const="hsv",
+        help="same as --metric hsv, kept for older scripts",
+    )
+    parser.add_argument(
+        "-m",
+        "--metric",
+        type=str,
+        default=None,
+        choices=sorted(metrics),
+        help="distance used to match colors, hsv by default",
     )
     parser.add_argument(
         "-n",
@@ -256,14 +1216,97 @@ def parse_args(args_):
         help="normalize to try and use more of the palette",
     )
     parser.add_argument("-o", "--output", default=None, help="output path for image")
+    parser.add_argument(
+        "-b",
+        "--batch",
+        type=str,
+        nargs="+",
+        default=None,
+        help="directories or globs of images to apply the palette to, skips up to date outputs",
+    )
+    parser.add_argument(
+        "-l",
+        "--lut",
+        type=int,
+        nargs="?",
+        const=8,
+        default=None,
+        choices=range(1, 9),
+        metavar="BITS",
+        help="map through a cached lookup table quantized to BITS per channel (default 8, exact)",
+    )
+    parser.add_argument(
+        "-k",
+        "--index",
+        default=False,
+        action="store_true",
+        help="search the palette with a k-d tree, faster for large palettes",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes, maps row bands of the image or whole images with --batch",
+    )
+    parser.add_argument(
+        "-q",
+        "--preview",
+        type=float,
+        nargs="?",
+        const=0.5,
+        default=None,
+        metavar="SECONDS",
+        help="write a quick preview scaled down to map in about SECONDS (default 0.5)",
+    )
+    parser.add_argument(
+        "-r",
+        "--refine",
+        default=False,
+        action="store_true",
+        help="after --preview also map the full image",
+    )
+    parser.add_argument(
+        "-c",
+        "--compile",
+        default=False,
+        action="store_true",
+        help="only compile the palette lookup table, don't map an image",
+    )
     return parser.parse_args(args_)
 
 
 def main(args):
     print(__file__, args.__dict__)
     runner = PaletteApplier(
-        palette=args.palette, image=args.image, output=args.output, using_hsv=args.hsv
+        palette=args.palette,
+        image=args.image,
+        output=args.output,
+        lut_bits=args.lut,
+        workers=args.workers,
+        metric=args.metric,
     )
+    if args.index:
+        runner.index_min_colors = 0
+        if not runner.metric.indexable:
+            print(f"{runner.metric_name} can't use the k-d tree, matching every color")
+    if args.compile:
+        runner._load_palette(runner.palette)
+        if args.index:
+            runner.build_index()
+        runner.compile_palette(args.lut or 8)
+        return
+    if args.batch:
+        PaletteBatch(runner, args.batch, workers=args.workers).main()
+        return
+    if args.preview is not None:
+        runner.prepare()
+        runner._load_image()
+        runner.save_preview(args.preview)
+        if args.refine:
+            runner.apply_palette()
+            runner.save_image()
+        return
     runner.main()
 
 
@@ -0,0 +1,302 @@
+#! python
+"""keep palettes loaded in a local server so mapping an image doesn't pay for startup
+python palette_server.py serve
+python palette_server.py map -p palette.png -i image.png
+"""
+import sys
+import argparse
+import json
+import os
+import pathlib
+import threading
+import time
+import collections
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_default_port = 8765
+
+
+class WarmPalettes:
+    """prepared PaletteApplier instances kept in memory, least recently used evicted first
+    an applier is keyed by the palette path, its mtime and the matching options, so
+    editing the palette file loads it again
+    """
+
+    def __init__(self, max_palettes=8):
+        self.max_palettes = max_palettes
+        self.appliers = collections.OrderedDict()
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, palette, metric, lut_bits):
+        palette = str(pathlib.Path(palette).resolve())
+        return (palette, os.path.getmtime(palette), metric, lut_bits)
+
+    def get(self, palette, metric="hsv", lut_bits=None):
+        """return a private copy of the prepared applier, preparing it on first use"""
+        from palette import PaletteApplier, metrics
+
+        if metric not in metrics:
+            raise ValueError(f"unknown metric {metric}, one of {sorted(metrics)}")
+        key = self.key(palette, metric, lut_bits)
+        with self.lock:
+            if key in self.appliers:
+                self.hits += 1
+                self.appliers.move_to_end(key)
+                return key, self._copy(self.appliers[key])
+            self.misses += 1
+            # only one request prepares a palette, the others for it wait here
+            prepare_lock = self.locks.setdefault(key, threading.Lock())
+        with prepare_lock:
+            with self.lock:
+                if key in self.appliers:
+                    return key, self._copy(self.appliers[key])
+            applier = PaletteApplier(key[0], None, lut_bits=lut_bits, metric=metric)
+            applier.show_progress = False
+            applier.prepare()
+            with self.lock:
+                self.appliers[key] = applier
+                self.locks.pop(key, None)
+                while len(self.appliers) > self.max_palettes:
+                    self.appliers.popitem(last=False)
+                return key, self._copy(applier)
+
+    def put_back(self, key, applier):
+        """keep the colors a request added to its copy's cache for later requests"""
+        with self.lock:
+            warm = self.appliers.get(key)
+            if warm is not None and len(applier.cache_keys) > len(warm.cache_keys):
+                warm.cache_keys = applier.cache_keys
+                warm.cache_values = applier.cache_values
+
+    def _copy(self, applier):
+        """the palette side is shared read only, the per image state is the copy's own"""
+        copy = object.__new__(type(applier))
+        copy.__dict__.update(applier.__dict__)
+        copy.hash_table = {}
+        return copy
+
+    def stats(self):
+        with self.lock:
+            return {
+                "palettes": [
+                    {
+                        "palette": key[0],
+                        "metric": key[2],
+                        "lut": key[3],
+                        "cached_colors": len(applier.cache_keys),
+                    }
+                    for key, applier in self.appliers.items()
+                ],
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class PaletteRequestHandler(BaseHTTPRequestHandler):
+    """POST /map with a json body maps image files
+    POST /map_buffer?palette=..&width=..&height=.. maps a raw rgba body and sends it back
+    GET /stats lists the warm palettes
+    requests read and write any path the user can, so anything a web page could send
+    is refused: requests with an Origin header, and bodies without the content type
+    of their path, which a browser can't send cross-origin without a preflight
+    """
+
+    palettes = None
+    content_types = {
+        "/map": "application/json",
+        "/map_buffer": "application/octet-stream",
+    }
+
+    def do_GET(self):
+        if "Origin" in self.headers:
+            self._send_json(403, {"error": "cross-origin requests are refused"})
+            return
+        if self.path != "/stats":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        self._send_json(200, self.palettes.stats())
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if "Origin" in self.headers:
+            self._send_json(403, {"error": "cross-origin requests are refused"})
+            return
+        content_type = self.content_types.get(url.path)
+        if content_type and self.headers.get_content_type() != content_type:
+            self._send_json(415, {"error": f"{url.path} takes {content_type}"})
+            return
+        try:
+            if url.path == "/map":
+                self._send_json(200, self.map_file(json.loads(body)))
+            elif url.path == "/map_buffer":
+                query = dict(urllib.parse.parse_qsl(url.query))
+                self._send_bytes(self.map_buffer(query, body))
+            else:
+                self._send_json(404, {"error": f"unknown path {url.path}"})
+        except Exception as err:
+            self._send_json(500, {"error": f"{type(err).__name__}: {err}"})
+
+    def map_file(self, request):
+        start = time.perf_counter()
+        metric = request.get("metric") or "hsv"
+        key, applier = self.palettes.get(request["palette"], metric, request.get("lut"))
+        num_px = applier.apply_to(request["image"], request.get("output"))
+        self.palettes.put_back(key, applier)
+        return {
+            "output": str(applier.output),
+            "px": num_px,
+            "seconds": time.perf_counter() - start,
+        }
+
+    def map_buffer(self, query, body):
+        import numpy as np
+
+        width, height = int(query["width"]), int(query["height"])
+        metric = query.get("metric") or "hsv"
+        lut_bits = int(query["lut"]) if "lut" in query else None
+        key, applier = self.palettes.get(query["palette"], metric, lut_bits)
+        pixels = np.frombuffer(body, dtype=np.uint8).reshape(height, width, 4).copy()
+        applier.map_pixels(pixels, progress=False)
+        self.palettes.put_back(key, applier)
+        return pixels.tobytes()
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_bytes(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(port=_default_port, max_palettes=8, verbose=False):
+    # load numpy and PIL now rather than on the first request
+    import palette  # noqa: F401
+
+    handler = type(
+        "Handler", (PaletteRequestHandler,), {"palettes": WarmPalettes(max_palettes)}
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.verbose = verbose
+    print(f"serving palettes on http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def request_map(
+    image, palette, output=None, metric="hsv", lut_bits=None, port=_default_port
+):
+    """ask the server to map an image file, returns its json reply"""
+    request = {
+        "image": os.path.abspath(image),
+        "palette": os.path.abspath(palette),
+        "output": os.path.abspath(output) if output else None,
+        "metric": metric,
+        "lut": lut_bits,
+    }
+    http_request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/map",
+        data=json.dumps(request).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(http_request) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as err:
+        return json.load(err)
+
+
+def main(args):
+    if args.command == "serve":
+        serve(args.port, args.max_palettes, args.verbose)
+        return
+    if args.command == "stats":
+        with urllib.request.urlopen(f"http://127.0.0.1:{args.port}/stats") as response:
+            print(json.dumps(json.load(response), indent=1))
+        return
+    for image in args.image:
+        metric = args.metric or "hsv"
+        reply = request_map(image, args.palette, args.output, metric, args.lut, args.port)
+        if "error" in reply:
+            print(f"failed {image}: {reply['error']}")
+        else:
+            print(f"{reply['output']}: {reply['px']} px in {reply['seconds'] * 1000:.1f}ms")
+
+
+def parse_args(args_):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command", choices=["serve", "map", "stats"], help="run the server or talk to it"
+    )
+    parser.add_argument(
+        "--port", type=int, default=_default_port, help="localhost port of the server"
+    )
+    parser.add_argument(
+        "-p",
+        "--palette",
+        type=str,
+        default=pathlib.Path(__file__).parent.joinpath("old_windows_palette.png"),
+        help="palette image to map with",
+    )
+    parser.add_argument(
+        "-i", "--image", type=str, nargs="+", default=[], help="images to map"
+    )
+    parser.add_argument(
+        "-o", "--output", default=None, help="output path, only with a single image"
+    )
+    parser.add_argument(
+        "-m",
+        "--metric",
+        type=str,
+        default=None,
+        help="distance used to match colors, see palette.py --help",
+    )
+    parser.add_argument(
+        "-l",
+        "--lut",
+        type=int,
+        nargs="?",
+        const=8,
+        default=None,
+        choices=range(1, 9),
+        metavar="BITS",
+        help="map through the palette's lookup table quantized to BITS per channel",
+    )
+    parser.add_argument(
+        "-s",
+        "--max-palettes",
+        type=int,
+        default=8,
+        help="palettes the server keeps loaded before evicting the least recently used",
+    )
+    parser.add_argument(
+        "--verbose", default=False, action="store_true", help="log every request"
+    )
+    return parser.parse_args(args_)
+
+
+if __name__ == "__main__":
+    main(parse_args(sys.argv[1:]))
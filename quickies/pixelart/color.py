@@ -1,24 +1,179 @@
 import colorsys
+import numpy as np
 
 # colorsys uses floats 0.0f-1.0f and PIL expects ints 0-255
 PIL_MAX = 255
 
 
+# array kernels work over the last axis of (..., 3) arrays, extra channels like
+# alpha are ignored. the hsv kernels do the same float operations in the same
+# order as colorsys, so they match it exactly, not just within a tolerance.
+# the lab kernels use srgb with a d65 white point, lab_to_rgb(rgb_to_lab(x))
+# gives back every uint8 color exactly
+
+
+def rgb_to_hsv(rgb, scale=1.0):
+    """colorsys.rgb_to_hsv over an array, rgb is divided by scale first
+    scale=PIL_MAX gives colorsys' 0-1 hsv for uint8 colors, with scale=1.0 v keeps
+    the scale of the input
+    """
+    rgb = np.asarray(rgb, dtype=np.float64)[..., :3]
+    if scale != 1.0:
+        rgb = rgb / scale
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    maxc = rgb.max(axis=-1)
+    minc = rgb.min(axis=-1)
+    rangec = maxc - minc
+    grey = rangec == 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s = rangec / maxc
+        rc = (maxc - r) / rangec
+        gc = (maxc - g) / rangec
+        bc = (maxc - b) / rangec
+    h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = (h / 6.0) % 1.0
+    h[grey] = 0.0
+    s[grey] = 0.0
+    return np.stack([h, s, maxc], axis=-1)
+
+
+def hsv_to_rgb(hsv, scale=1.0):
+    """colorsys.hsv_to_rgb over an array, the result is multiplied by scale"""
+    hsv = np.asarray(hsv, dtype=np.float64)
+    h, s, v = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    i = (h * 6.0).astype(np.int64)
+    f = (h * 6.0) - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    i = i % 6
+    sextants = [(v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v), (v, p, q)]
+    rgb = np.empty(hsv.shape[:-1] + (3,))
+    for channel in range(3):
+        rgb[..., channel] = np.select(
+            [i == n for n in range(6)], [sextant[channel] for sextant in sextants]
+        )
+    rgb[s == 0.0] = v[s == 0.0, None]
+    if scale != 1.0:
+        rgb *= scale
+    return rgb
+
+
+_D65 = np.array([0.95047, 1.0, 1.08883])
+_RGB_TO_XYZ = np.array(
+    [
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ]
+)
+_XYZ_TO_RGB = np.linalg.inv(_RGB_TO_XYZ)
+
+
+def rgb_to_lab(rgb):
+    """cielab (d65) for 0-255 srgb colors, L is 0-100"""
+    rgb = np.asarray(rgb, dtype=np.float64)[..., :3] / PIL_MAX
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ _RGB_TO_XYZ.T / _D65
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack(
+        [116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])],
+        axis=-1,
+    )
+
+
+def lab_to_rgb(lab):
+    """0-255 uint8 srgb for cielab (d65) colors, out of gamut colors are clipped"""
+    lab = np.asarray(lab, dtype=np.float64)
+    fy = (lab[..., 0] + 16) / 116
+    f = np.stack([fy + lab[..., 1] / 500, fy, fy - lab[..., 2] / 200], axis=-1)
+    xyz = np.where(f > 6 / 29, f**3, 3 * (6 / 29) ** 2 * (f - 4 / 29)) * _D65
+    linear = np.clip(xyz @ _XYZ_TO_RGB.T, 0.0, 1.0)
+    rgb = np.where(
+        linear <= 0.0031308, linear * 12.92, 1.055 * linear ** (1 / 2.4) - 0.055
+    )
+    return np.rint(rgb * PIL_MAX).astype(np.uint8)
+
+
+def unique_colors(image):
+    """return the distinct opaque colors of a PIL image as an (N, 3) uint8 rgb array
+    ordered by where they first show up walking the image column by column
+    """
+    pixels = np.asarray(image.convert("RGBA"))
+    pixels = pixels.transpose(1, 0, 2).reshape(-1, 4)
+    pixels = pixels[pixels[:, 3] != 0]
+    packed = pixels[:, 0].astype(np.uint32) << 16
+    packed |= pixels[:, 1].astype(np.uint32) << 8
+    packed |= pixels[:, 2]
+    first_seen = np.unique(packed, return_index=True)[1]
+    return pixels[np.sort(first_seen), :3]
+
+
+def pack_rgba(pixels):
+    """pack an (N, 4) uint8 rgba array into uint32 0xRRGGBBAA values, same as Color.hex"""
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8).reshape(-1, 4)
+    return pixels.view(">u4").ravel().astype(np.uint32)
+
+
+def unpack_rgba(packed):
+    """unpack uint32 0xRRGGBBAA values into an (N, 4) uint8 rgba array"""
+    return np.asarray(packed).astype(">u4").view(np.uint8).reshape(-1, 4)
+
+
+def color_histogram(image, opaque=False, band_px=1 << 21):
+    """count the pixels of each color in a PIL image, fully transparent pixels are skipped
+    returns packed 0xRRGGBBAA colors sorted by value and the number of pixels of each
+    the image is converted a band of rows at a time and merged into the running
+    counts, so memory grows with the number of colors rather than the pixel count
+    opaque counts every visible pixel as alpha 255
+    """
+    histogram = (np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.int64))
+    band_height = max(1, band_px // max(1, image.width))
+    for top in range(0, image.height, band_height):
+        bottom = min(top + band_height, image.height)
+        band = image.crop((0, top, image.width, bottom)).convert("RGBA")
+        band = np.asarray(band).reshape(-1, 4)
+        band = band[band[:, 3] != 0]
+        if opaque:
+            band[:, 3] = 255
+        band_histogram = np.unique(pack_rgba(band), return_counts=True)
+        histogram = merge_histograms([histogram, band_histogram])
+    return histogram
+
+
+def merge_histograms(histograms):
+    """add up (colors, counts) histograms into one sorted by color"""
+    histograms = list(histograms)
+    if not histograms:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.int64)
+    colors, inverse = np.unique(
+        np.concatenate([colors for colors, _ in histograms]), return_inverse=True
+    )
+    counts = np.zeros(len(colors), dtype=np.int64)
+    np.add.at(counts, inverse, np.concatenate([counts for _, counts in histograms]))
+    return colors, counts
+
+
 class Color:
-    """Color object for use with PIL and colorsys"""
+    """Color object for use with PIL and colorsys
+    stores 0-255 rgba ints, hsv is worked out from them when asked for
+    """
+
+    __slots__ = ("r", "g", "b", "a")
 
     def __init__(self, rgba=(0, 0, 0, 0), hsv=None):
         if hsv is None:
-            if isinstance(rgba, tuple):
+            if isinstance(rgba, (tuple, list)):
                 self._set_rgba(*rgba)
             else:
                 self.hex = rgba
         else:
+            self.a = PIL_MAX
             self._set_hsv(*hsv)
 
     @property
     def rgba(self):
-        return tuple(self.r, self.g, self.b, self.a)
+        return (self.r, self.g, self.b, self.a)
 
     def _set_rgba(self, r, g, b, a=PIL_MAX):
         self.r = int(r * PIL_MAX) if isinstance(r, float) else r
@@ -28,37 +183,32 @@ class Color:
 
     @property
     def colorsys_rgba(self):
-        return tuple(
-            self.r / PIL_MAX, self.g / PIL_MAX, self.b / PIL_MAX, self.a / PIL_MAX
-        )
+        return (self.r / PIL_MAX, self.g / PIL_MAX, self.b / PIL_MAX, self.a / PIL_MAX)
 
     @rgba.setter
     def rgba(self, rgba):
         self._set_rgba(*rgba)
-        hsv = self.rgb_to_hsv(self.rgba)
-        self._set_hsv(hsv)
 
     @property
     def hsv(self):
-        return tuple(self.h, self.s, self.v)
+        return self.rgb_to_hsv(self.rgba)
 
     def _set_hsv(self, h, s, v):
-        self.h = h if isinstance(h, float) else h / PIL_MAX
-        self.s = s if isinstance(s, float) else s / PIL_MAX
-        self.v = v if isinstance(v, float) else v / PIL_MAX
+        h = h if isinstance(h, float) else h / PIL_MAX
+        s = s if isinstance(s, float) else s / PIL_MAX
+        v = v if isinstance(v, float) else v / PIL_MAX
+        self._set_rgba(*self.hsv_to_rgb((h, s, v)), self.a)
 
     @hsv.setter
     def hsv(self, hsv):
         self._set_hsv(*hsv)
-        rgba = self.hsv_to_rgb(self.hsv)
-        self._set_rgba(*rgba)
 
     def rgb_to_hsv(self, rgb):
-        return colorsys.rgb_to_hsv(self.r / PIL_MAX, self.g / PIL_MAX, self.b / PIL_MAX)
+        return colorsys.rgb_to_hsv(rgb[0] / PIL_MAX, rgb[1] / PIL_MAX, rgb[2] / PIL_MAX)
 
     def hsv_to_rgb(self, hsv):
         retval = colorsys.hsv_to_rgb(*hsv)
-        retval = tuple(int(x * PIL_MAX) for x in retval)
+        return tuple(int(round(x * PIL_MAX)) for x in retval)
 
     @property
     def hex(self):
@@ -88,11 +238,18 @@ class Color:
         return self.__repr__()
 
     def __eq__(self, other):
+        if not isinstance(other, Color):
+            return NotImplemented
         return self.rgba == other.rgba
 
     def __ne__(self, other):
+        if not isinstance(other, Color):
+            return NotImplemented
         return self.rgba != other.rgba
 
+    def __hash__(self):
+        return hash(self.rgba)
+
     def __add__(self, other):
         _r = min(PIL_MAX, self.r + other.r)
         _g = min(PIL_MAX, self.g + other.g)
@@ -108,17 +265,17 @@ class Color:
         return Color(rgba=(_r, _g, _b, _a))
 
     def __mul__(self, other):
-        _r = min(PIL_MAX, self.r * other)
-        _g = min(PIL_MAX, self.g * other)
-        _b = min(PIL_MAX, self.b * other)
-        _a = min(PIL_MAX, self.a * other)
+        _r = int(min(PIL_MAX, self.r * other))
+        _g = int(min(PIL_MAX, self.g * other))
+        _b = int(min(PIL_MAX, self.b * other))
+        _a = int(min(PIL_MAX, self.a * other))
         return Color(rgba=(_r, _g, _b, _a))
 
     def __truediv__(self, other):
-        _r = max(0, self.r / other)
-        _g = max(0, self.g / other)
-        _b = max(0, self.b / other)
-        _a = max(0, self.a / other)
+        _r = int(max(0, self.r / other))
+        _g = int(max(0, self.g / other))
+        _b = int(max(0, self.b / other))
+        _a = int(max(0, self.a / other))
         return Color(rgba=(_r, _g, _b, _a))
 
     def __floordiv__(self, other):
@@ -127,3 +284,141 @@ class Color:
         _b = max(0, self.b // other)
         _a = max(0, self.a // other)
         return Color(rgba=(_r, _g, _b, _a))
+
+
+class ColorArray:
+    """N colors as a struct of arrays, one contiguous uint8 buffer per rgba channel
+    the array version of Color for when there are too many colors for an object each.
+    arithmetic saturates at 0-255 the same way Color does, == compares color by color
+    """
+
+    __slots__ = ("channels",)
+
+    def __init__(self, rgba=()):
+        if isinstance(rgba, ColorArray):
+            rgba = rgba.rgba
+        elif len(rgba) and isinstance(rgba[0], Color):
+            rgba = [c.rgba for c in rgba]
+        rgba = np.asarray(rgba, dtype=np.uint8).reshape(-1, 4)
+        self.channels = np.ascontiguousarray(rgba.T)
+
+    @classmethod
+    def from_hex(cls, hex):
+        """from packed 0xRRGGBBAA values"""
+        return cls(unpack_rgba(hex))
+
+    @classmethod
+    def from_hsv(cls, hsv, a=PIL_MAX):
+        """from colorsys 0-1 hsv values, all with the same alpha"""
+        hsv = np.asarray(hsv, dtype=np.float64).reshape(-1, 3)
+        rgba = np.empty((len(hsv), 4), dtype=np.uint8)
+        rgba[:, :3] = np.rint(hsv_to_rgb(hsv, scale=PIL_MAX))
+        rgba[:, 3] = a
+        return cls(rgba)
+
+    @classmethod
+    def from_image(cls, image):
+        """every pixel of a PIL image, row by row"""
+        return cls(np.asarray(image.convert("RGBA")))
+
+    @property
+    def r(self):
+        return self.channels[0]
+
+    @property
+    def g(self):
+        return self.channels[1]
+
+    @property
+    def b(self):
+        return self.channels[2]
+
+    @property
+    def a(self):
+        return self.channels[3]
+
+    @property
+    def rgba(self):
+        """(N, 4) uint8 array"""
+        return self.channels.T
+
+    @property
+    def hex(self):
+        """(N,) uint32 array of 0xRRGGBBAA values, same as Color.hex"""
+        return pack_rgba(self.rgba)
+
+    @property
+    def hsv(self):
+        """(N, 3) float32 array of colorsys 0-1 hsv values"""
+        return rgb_to_hsv(self.rgba, scale=PIL_MAX).astype(np.float32)
+
+    @property
+    def lab(self):
+        """(N, 3) float32 array of cielab values"""
+        return rgb_to_lab(self.rgba).astype(np.float32)
+
+    def unique(self, return_counts=False):
+        """the distinct colors in the order they first show up"""
+        packed = self.hex
+        _, first, counts = np.unique(packed, return_index=True, return_counts=True)
+        order = np.argsort(first)
+        colors = ColorArray.from_hex(packed[first[order]])
+        if return_counts:
+            return colors, counts[order]
+        return colors
+
+    def _channels_of(self, other):
+        """other as something that broadcasts against self.channels"""
+        if isinstance(other, (ColorArray, Color)):
+            other = ColorArray([other]) if isinstance(other, Color) else other
+            return other.channels.astype(np.int32)
+        return np.asarray(other)
+
+    def _saturate(self, channels):
+        new = ColorArray.__new__(ColorArray)
+        new.channels = np.ascontiguousarray(np.clip(channels, 0, PIL_MAX), dtype=np.uint8)
+        return new
+
+    # operators
+    def __len__(self):
+        return self.channels.shape[1]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return Color(rgba=tuple(self.channels[:, key].tolist()))
+        new = ColorArray.__new__(ColorArray)
+        new.channels = np.ascontiguousarray(self.channels[:, key])
+        return new
+
+    def __iter__(self):
+        for rgba in self.rgba.tolist():
+            yield Color(rgba=tuple(rgba))
+
+    def __repr__(self):
+        return f"ColorArray(n={len(self)}, rgba={self.rgba.tolist()[:4]}...)"
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __eq__(self, other):
+        return (self.channels == self._channels_of(other)).all(axis=0)
+
+    def __ne__(self, other):
+        return ~self.__eq__(other)
+
+    __hash__ = None
+
+    def __add__(self, other):
+        return self._saturate(self.channels.astype(np.int32) + self._channels_of(other))
+
+    def __sub__(self, other):
+        return self._saturate(self.channels.astype(np.int32) - self._channels_of(other))
+
+    def __mul__(self, other):
+        return self._saturate(self.channels.astype(np.int32) * self._channels_of(other))
+
+    def __truediv__(self, other):
+        return self._saturate(self.channels / self._channels_of(other))
+
+    def __floordiv__(self, other):
+        return self._saturate(self.channels // self._channels_of(other))
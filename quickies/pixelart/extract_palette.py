@@ -1,28 +1,37 @@
 #! python
 #! python
 import os
-from PIL import Image
+from PIL import Image, ImageSequence
 import pathlib
 import sys
 import argparse
-import colorsys
 import math
+import glob
+import hashlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from . import color
 
 test_img = pathlib.Path(
     "E:\\pics\\reference\\trythis\\sprites\\loopHeroPortraits_trans.png"
 )
+_histogram_dir = pathlib.Path.home().joinpath(".cache", "cool_cli_stuff", "histograms")
+image_suffixes = {".png", ".gif", ".bmp", ".tga", ".webp"}
 
 
 class PaletteExtractor:
-    def __init__(self, image, output=None, using_hsv=True):
+    def __init__(self, image, output=None, using_hsv=True, top=None, sort_by=None):
         # self.image = image
         self.image_path = pathlib.Path(image)
         self.output = output
         self.palette_image = None
         self.using_hsv = using_hsv
+        self.top = top
+        # None sorts by hue when using hsv, "count" puts the most used colors first
+        self.sort_by = sort_by
         self.colors = []
         self.hsv_palette = []
+        self.counts = []
 
     def update_percent(self):
         self.i_px += 1
@@ -37,35 +46,48 @@ class PaletteExtractor:
 
         with Image.open(self.image_path) as image_obj:
             self.num_px = image_obj.width * image_obj.height
-            self.i_px = 0
-            self.percent_complete = 0
-            for x in range(0, image_obj.width):
-                for y in range(0, image_obj.height):
-                    pixel = image_obj.getpixel((x, y))
-
-                    if pixel[3] == 0:
-                        continue
-                    new_pixel = (pixel[0], pixel[1], pixel[2], 255)
-                    new_hsv = colorsys.rgb_to_hsv(
-                        pixel[0] / 255, pixel[1] / 255, pixel[2] / 255
-                    )
-                    if new_pixel not in self.colors:
-                        self.colors.append(new_pixel)
-                    if new_hsv not in self.hsv_palette:
-                        self.hsv_palette.append(new_hsv)
-                    self.update_percent()
+            colors = color.unique_colors(image_obj).tolist()
+        self.colors = [(r, g, b, 255) for r, g, b in colors]
+        self.hsv_palette = hsv_palette(self.colors)
+
+    def _load_histogram(self):
+        """colors and how many pixels use each in one banded pass, ordered by value
+        used instead of _load_palette when counts are needed, memory grows with
+        the number of colors rather than the size of the image
+        """
+        with Image.open(self.image_path) as image_obj:
+            self.num_px = image_obj.width * image_obj.height
+            packed, counts = color.color_histogram(image_obj, opaque=True)
+        self.colors = [tuple(rgba) for rgba in color.unpack_rgba(packed).tolist()]
+        self.counts = counts.tolist()
+        self.hsv_palette = hsv_palette(self.colors)
+
+    def _trim_palette(self, top):
+        """keep only the top most used colors, in the order they were loaded"""
+        by_count = sorted(range(len(self.colors)), key=lambda i: -self.counts[i])
+        keep = sorted(by_count[:top])
+        self.colors = [self.colors[i] for i in keep]
+        self.counts = [self.counts[i] for i in keep]
+        self.hsv_palette = hsv_palette(self.colors)
 
     def main(self):
-        self._load_palette()
+        if self.top or self.sort_by == "count":
+            self._load_histogram()
+        else:
+            self._load_palette()
+        if self.top:
+            self._trim_palette(self.top)
         self._create_palette_image()
         self._save_palette_image()
 
     def _create_palette_image(self):
         """create a new image with 16x16 squares of each color sorted by hue
+        or by pixel count with sort_by="count"
         each row has 4 squares of 16x16
         """
         sq_size = 16
-        colors_list = self.hsv_palette if self.using_hsv else self.colors
+        hsv_list = self.using_hsv and self.sort_by != "count"
+        colors_list = self.hsv_palette if hsv_list else self.colors
         mode = "RGBA"  # "HSV" if self.using_hsv else "RGBA"
         num_columns = 4
         num_rows = math.ceil(len(self.colors) / num_columns)
@@ -73,23 +95,21 @@ class PaletteExtractor:
         self.palette_image = Image.new(
             mode, (sq_size * num_columns, sq_size * num_rows), (0, 0, 0, 0)
         )
-        if self.using_hsv:
-            colors_list = sorted(colors_list, key=lambda x: x[0])
+        if hsv_list:
+            hsv = np.array(colors_list).reshape(-1, 3)
+            by_hue = np.argsort(hsv[:, 0], kind="stable")
+            rgb = color.hsv_to_rgb(hsv[by_hue], scale=255).astype(int)
+            colors_list = [(r, g, b, 255) for r, g, b in rgb.tolist()]
+        elif self.sort_by == "count":
+            colors_list = [
+                colors_list[i]
+                for i in sorted(range(len(colors_list)), key=lambda i: -self.counts[i])
+            ]
 
-        for i, color in enumerate(colors_list):
+        for i, this_color in enumerate(colors_list):
             x = (i % num_columns) * sq_size
             y = (i // num_columns) * sq_size
-            this_color = color
-            if self.using_hsv:
-                this_color = colorsys.hsv_to_rgb(*color)
-                this_color = (
-                    int(this_color[0] * 255),
-                    int(this_color[1] * 255),
-                    int(this_color[2] * 255),
-                    255,
-                )
-
-            new_square = Image.new("RGBA", (sq_size, sq_size), this_color)
+            new_square = Image.new("RGBA", (sq_size, sq_size), tuple(this_color))
             self.palette_image.paste(new_square, (x, y))
             # for x_ in range(x, x + 16):
             #     for y_ in range(y, y + 16):
@@ -105,34 +125,114 @@ class PaletteExtractor:
             )
         self.palette_image.save(output_path)
 
-    def extract_palette():
-        """return list of color objects used in the image"""
-        palette = []
+    def extract_palette(self):
+        """return (rgba, pixel count) for every color used in the image, most used first"""
         with Image.open(self.image_path) as image_obj:
-            for x in range(0, image_obj.width):
-                for y in range(0, image_obj.height):
-                    pixel = image_obj.getpixel((x, y))
-
-                    if pixel[3] == 0:
-                        continue
-                    new_color = color.Color(rgba=pixel)
-                    if new_color not in palette:
-                        palette.append(new_color)
-
-                    # new_pixel = (pixel[0], pixel[1], pixel[2], 255)
-                    # new_hsv = colorsys.rgb_to_hsv(
-                    #     pixel[0] / 255, pixel[1] / 255, pixel[2] / 255
-                    # )
-                    # if new_pixel not in self.colors:
-                    #     self.colors.append(new_pixel)
-                    # if new_hsv not in self.hsv_palette:
-                    #     self.hsv_palette.append(new_hsv)
+            packed, counts = color.color_histogram(image_obj)
+        order = np.argsort(-counts, kind="stable")
+        rgba = color.unpack_rgba(packed[order]).tolist()
+        return [(tuple(rgba[i]), int(count)) for i, count in enumerate(counts[order])]
+
+
+def hsv_palette(colors):
+    """colorsys 0-1 hsv for a list of 0-255 rgb(a) tuples, without duplicates"""
+    hsv = color.rgb_to_hsv(np.array(colors, dtype=np.uint8).reshape(-1, 4), scale=255)
+    return list(dict.fromkeys(map(tuple, hsv.tolist())))
+
+
+class CollectionPaletteExtractor(PaletteExtractor):
+    """one palette for a whole collection of images, every frame of animations included
+    each file's histogram is computed in a process pool and cached by the file's hash,
+    so re-running after one asset changes only recounts that file
+    """
+
+    def __init__(self, images, output=None, workers=None, **kwargs):
+        self.image_paths = expand_inputs(images)
+        if not self.image_paths:
+            raise FileNotFoundError(f"no images found in {images}")
+        if output is None:
+            output = pathlib.Path(
+                os.path.commonpath([path.parent for path in self.image_paths])
+            ).joinpath("palette_collection.png")
+        super().__init__(self.image_paths[0], output=output, **kwargs)
+        self.workers = workers
+
+    def _load_palette(self):
+        """merge the histograms of every input, colors end up ordered by value"""
+        with ProcessPoolExecutor(self.workers) as pool:
+            histograms = list(pool.map(cached_file_histogram, self.image_paths))
+        packed, counts = color.merge_histograms(histograms)
+        self.num_px = int(counts.sum())
+        self.colors = [tuple(rgba) for rgba in color.unpack_rgba(packed).tolist()]
+        self.counts = counts.tolist()
+        self.hsv_palette = hsv_palette(self.colors)
+
+    def _load_histogram(self):
+        """counts come with the merged histograms"""
+        self._load_palette()
+
+
+def expand_inputs(inputs):
+    """return the image files in a list of files, directories and globs"""
+    paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            matches = sorted(pathlib.Path(pattern).iterdir())
+        else:
+            matches = [pathlib.Path(match) for match in sorted(glob.glob(pattern))]
+        paths.extend(
+            path
+            for path in matches
+            if path.suffix.lower() in image_suffixes and path.is_file()
+        )
+    return list(dict.fromkeys(paths))
+
+
+def file_histogram(path):
+    """histogram of every frame of an image file, visible pixels counted as opaque"""
+    with Image.open(path) as image_obj:
+        return color.merge_histograms(
+            color.color_histogram(frame, opaque=True)
+            for frame in ImageSequence.Iterator(image_obj)
+        )
+
+
+def cached_file_histogram(path):
+    """file_histogram, kept on disk under the sha256 of the file"""
+    with open(path, "rb") as image_file:
+        key = hashlib.sha256(image_file.read()).hexdigest()
+    cache_path = _histogram_dir.joinpath(f"{key[:32]}_opaque.npz")
+    if cache_path.exists():
+        with np.load(cache_path) as cached:
+            return cached["colors"], cached["counts"]
+    colors, counts = file_histogram(path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as cache_file:
+        np.savez(cache_file, colors=colors, counts=counts)
+    os.replace(tmp_path, cache_path)
+    return colors, counts
 
 
 def main(args):
     print(__file__, args.__dict__)
+    if args.aggregate:
+        runner = CollectionPaletteExtractor(
+            images=args.aggregate,
+            output=args.output,
+            workers=args.workers,
+            using_hsv=(not args.rgb),
+            top=args.top,
+            sort_by=args.sort,
+        )
+        runner.main()
+        return
     runner = PaletteExtractor(
-        image=args.image, output=args.output, using_hsv=(not args.rgb)
+        image=args.image,
+        output=args.output,
+        using_hsv=(not args.rgb),
+        top=args.top,
+        sort_by=args.sort,
     )
     runner.main()
 
@@ -156,6 +256,36 @@ def parse_args(args_):
         default=None,
         help="output path for palette image",
     )
+    parser.add_argument(
+        "-t",
+        "--top",
+        type=int,
+        default=None,
+        help="only keep the N most used colors",
+    )
+    parser.add_argument(
+        "-s",
+        "--sort",
+        type=str,
+        default=None,
+        choices=["hue", "count"],
+        help="order of the palette squares, hue by default with hsv",
+    )
+    parser.add_argument(
+        "-a",
+        "--aggregate",
+        type=str,
+        nargs="+",
+        default=None,
+        help="files, directories or globs to build one palette from, gif frames included",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="processes used to count colors with --aggregate, defaults to one per cpu",
+    )
 
     return parser.parse_args(args_)
 
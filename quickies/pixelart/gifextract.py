@@ -3,9 +3,21 @@ import logging
 import sys
 import os
 import argparse
-from PIL import Image
+from PIL import Image, ImageDraw
 import pathlib
 import enum
+import struct
+import hashlib
+import json
+import math
+import collections
+import glob
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+_manifest_path = pathlib.Path.home().joinpath(
+    ".cache", "cool_cli_stuff", "gifextract_manifest.json"
+)
 
 outline_types = enum.Enum("outline_types", "full dots none")
 """ outline type is for the texture output to have divisions in it, to help user devide it
@@ -41,12 +53,92 @@ Nov 2012
 """
 
 
+def readGifHeaders(path):
+    """
+    Walk the block structure of a GIF without decoding any pixel data.
+    Returns the logical screen size and, for every frame, its update box
+    (left, top, right, bottom), disposal method, duration in ms and
+    transparent color index. Returns None if the file isn't a GIF.
+    """
+    with open(path, "rb") as gif_file:
+        data = gif_file.read()
+    if data[:3] != b"GIF":
+        return None
+
+    size = struct.unpack_from("<HH", data, 6)
+    flags = data[10]
+    pos = 13
+    if flags & 0x80:
+        pos += 3 << ((flags & 0x07) + 1)
+
+    frames = []
+    control = {}
+    try:
+        while pos < len(data) and data[pos] != 0x3B:
+            if data[pos] == 0x21:
+                label = data[pos + 1]
+                pos += 2
+                if label == 0xF9 and data[pos] >= 4:
+                    packed, delay, transparency = struct.unpack_from("<BHB", data, pos + 1)
+                    control = {
+                        "disposal": (packed >> 2) & 0x07,
+                        "duration": delay * 10,
+                        "transparency": transparency if packed & 0x01 else None,
+                    }
+                pos = _skipSubBlocks(data, pos)
+            elif data[pos] == 0x2C:
+                left, top, width, height, flags = struct.unpack_from(
+                    "<HHHHB", data, pos + 1
+                )
+                pos += 10
+                if flags & 0x80:
+                    pos += 3 << ((flags & 0x07) + 1)
+                # skip the lzw minimum code size and the image data
+                pos = _skipSubBlocks(data, pos + 1)
+                frames.append(
+                    {
+                        "box": (left, top, left + width, top + height),
+                        "disposal": control.get("disposal", 0),
+                        "duration": control.get("duration", 0),
+                        "transparency": control.get("transparency"),
+                    }
+                )
+                control = {}
+            else:
+                logging.debug(f"unexpected gif block {data[pos]:#x} at {pos}")
+                break
+    except (IndexError, struct.error):
+        logging.debug(f"{path} is truncated after {len(frames)} frames")
+    return {"size": size, "frames": frames}
+
+
+def _skipSubBlocks(data, pos):
+    """return the position after a chain of data sub-blocks"""
+    while data[pos] != 0:
+        pos += data[pos] + 1
+    return pos + 1
+
+
 def analyseImage(path):
     """
     Pre-process pass over the image to determine the mode (full or additive).
     Necessary as assessing single frames isn't reliable. Need to know the mode
     before processing all frames.
+    GIFs are assessed from their frame headers alone, other formats are seeked
+    through frame by frame.
     """
+    headers = readGifHeaders(path)
+    if headers is not None:
+        results = {
+            "size": headers["size"],
+            "mode": "full",
+        }
+        for frame in headers["frames"]:
+            if frame["box"][2:] != headers["size"]:
+                results["mode"] = "partial"
+                break
+        return results
+
     im = Image.open(path)
     results = {
         "size": im.size,
@@ -67,102 +159,636 @@ def analyseImage(path):
     return results
 
 
-def processImageToTexture(
-    path,
-    partial=None,
-    texture=True,
-    outline_type=outline_types.none,
-    px_pad=1,
-    odd_color=(2, 210, 69, 255),
-):
-    """the same as the last one but it makes a texture instead of a sequence of images"""
+class GifCompositor:
+    """
+    Keeps one working RGBA canvas and applies only each frame's update rectangle.
+    Before a frame is drawn the previous frame is disposed of: disposal 2 clears
+    its rectangle to the background color, disposal 3 puts back what was under it.
+    In full mode every frame starts from a cleared canvas instead.
+
+    The canvas is reused for every frame, so consumers that keep frames around
+    have to take a snapshot().
+    """
 
-    mode = analyseImage(path)["mode"]
+    def __init__(self, size, partial=True, bg_color=(0, 0, 0, 0)):
+        self.size = size
+        self.partial = partial
+        self.bg_color = bg_color
+        self.canvas = Image.new("RGBA", size, bg_color)
+        self._disposal = 0
+        self._box = None
+        self._saved = None
+
+    def add(self, im, box=None, disposal=0):
+        """
+        Composite the decoded frame im onto the canvas and return the canvas.
+        box is the frame's update rectangle (left, top, right, bottom), only that
+        part of im is converted and copied. Defaults to the whole frame.
+        """
+        full_box = (0, 0) + self.size
+        if not self.partial:
+            self.canvas.paste(self.bg_color, full_box)
+            box = full_box
+        else:
+            self._dispose()
+            box = self._clip(box or full_box)
+
+        self._disposal = disposal
+        self._box = box
+        self._saved = self.canvas.crop(box) if disposal == 3 else None
+
+        region = im.convert("RGBA") if box == full_box else im.crop(box).convert("RGBA")
+        self.canvas.paste(region, box[:2], region)
+        return self.canvas
+
+    def snapshot(self):
+        """a copy of the current frame that later frames won't change"""
+        return self.canvas.copy()
+
+    def _dispose(self):
+        if self._box is None:
+            return
+        if self._disposal == 2:
+            self.canvas.paste(self.bg_color, self._box)
+        elif self._disposal == 3 and self._saved is not None:
+            self.canvas.paste(self._saved, self._box[:2])
+
+    def _clip(self, box):
+        left, top, right, bottom = box
+        return (
+            max(0, left),
+            max(0, top),
+            min(self.size[0], right),
+            min(self.size[1], bottom),
+        )
 
-    im = Image.open(path)
 
-    i = 0
-    p = im.getpalette()
+class TextureAtlas:
+    """
+    Packs animation frames into texture pages no bigger than max_size.
+    Frames with identical pixels are stored once, in a slot, and a json sidecar
+    maps every frame to its slot along with the frame durations, so the sheet can
+    be loaded without scanning it.
+
+    "grid" keeps every frame at full size in rows and columns, "maxrects" trims
+    the transparent border off each frame and packs the trimmed rectangles,
+    the offset of the trimmed rectangle within the frame goes in the sidecar.
+    """
 
-    last_frame = im.convert("RGBA")
-    if texture:
-        new_size = (
-            px_pad + ((px_pad + im.width) * im.n_frames),
-            im.height + px_pad * 2,
+    layouts = ("grid", "maxrects")
+
+    def __init__(
+        self,
+        layout="grid",
+        max_size=(4096, 4096),
+        px_pad=1,
+        outline_type=outline_types.none,
+        odd_color=(2, 210, 69, 255),
+    ):
+        if layout not in self.layouts:
+            raise ValueError(f"layout must be one of {self.layouts}, not {layout}")
+        self.layout = layout
+        self.max_size = max_size
+        self.px_pad = px_pad
+        self.outline_type = outline_type
+        self.odd_color = odd_color
+        self.frame_size = None
+        self.slots = []
+        self.frames = []
+        self._slot_by_hash = {}
+
+    def add(self, frame, duration=0):
+        """add a frame, it is copied if it's new, returns its slot number"""
+        self.frame_size = frame.size
+        key = hashlib.sha1(frame.tobytes()).digest()
+        if key not in self._slot_by_hash:
+            self._slot_by_hash[key] = len(self.slots)
+            offset = (0, 0)
+            if self.layout == "maxrects":
+                bbox = frame.getchannel("A").getbbox() or (0, 0, 0, 0)
+                offset = bbox[:2]
+                image = frame.crop(bbox)
+            else:
+                image = frame.copy()
+            self.slots.append({"image": image, "offset": offset})
+        slot = self._slot_by_hash[key]
+        self.frames.append({"slot": slot, "duration": duration})
+        return slot
+
+    def pack(self):
+        """work out the page and position of every slot"""
+        if self.layout == "grid":
+            self._pack_grid()
+        else:
+            self._pack_maxrects()
+
+    def _pack_grid(self):
+        pad = self.px_pad
+        width, height = self.frame_size
+        self._check_fits(width, height)
+        # as close to square as the page allows
+        columns = min(
+            math.ceil(math.sqrt(len(self.slots) * height / width)),
+            (self.max_size[0] - pad) // (width + pad),
         )
-        new_image = Image.new("RGBA", new_size)
-    good_job = False
-    new_files = []
-    try:
+        rows = (self.max_size[1] - pad) // (height + pad)
+        for i, slot in enumerate(self.slots):
+            page, cell = divmod(i, columns * rows)
+            slot["page"] = page
+            slot["x"] = pad + (cell % columns) * (width + pad)
+            slot["y"] = pad + (cell // columns) * (height + pad)
+
+    def _pack_maxrects(self):
+        pad = self.px_pad
+        pages = []
+        # tallest first packs tighter
+        order = sorted(
+            range(len(self.slots)),
+            key=lambda i: self.slots[i]["image"].size[::-1],
+            reverse=True,
+        )
+        for i in order:
+            slot = self.slots[i]
+            width, height = slot["image"].size
+            slot.update(page=0, x=pad, y=pad)
+            if not width or not height:
+                continue
+            self._check_fits(width, height)
+            for page_number, page in enumerate(pages):
+                position = page.insert(width + pad, height + pad)
+                if position:
+                    break
+            else:
+                page_number = len(pages)
+                pages.append(
+                    _MaxRectsPage(self.max_size[0] - pad, self.max_size[1] - pad)
+                )
+                position = pages[-1].insert(width + pad, height + pad)
+            slot.update(page=page_number, x=position[0] + pad, y=position[1] + pad)
+
+    def _check_fits(self, width, height):
+        if width + 2 * self.px_pad > self.max_size[0] or (
+            height + 2 * self.px_pad > self.max_size[1]
+        ):
+            raise ValueError(f"a {width}x{height} frame doesn't fit in {self.max_size}")
+
+    def save(self, path):
+        """
+        Pack and write the pages and the sidecar next to path.
+        One page is saved as path itself, more get -0, -1, ... added to the stem.
+        The sidecar is path with a .json suffix. Returns the files written.
+        """
+        path = pathlib.Path(path)
+        self.pack()
+        num_pages = max([slot["page"] for slot in self.slots], default=0) + 1
+        page_paths = [path] if num_pages == 1 else [
+            path.with_name(f"{path.stem}-{page}{path.suffix}") for page in range(num_pages)
+        ]
+
+        for page, page_path in enumerate(page_paths):
+            slots = [slot for slot in self.slots if slot["page"] == page]
+            page_size = (
+                max(slot["x"] + slot["image"].width for slot in slots) + self.px_pad,
+                max(slot["y"] + slot["image"].height for slot in slots) + self.px_pad,
+            )
+            page_image = Image.new("RGBA", page_size)
+            for slot in slots:
+                page_image.paste(slot["image"], (slot["x"], slot["y"]))
+            self._outline(page_image, slots)
+            logging.debug(page_path)
+            page_image.save(page_path, "PNG")
+
+        sidecar_path = path.with_suffix(".json")
+        with open(sidecar_path, "w") as sidecar:
+            json.dump(self.sidecar(page_paths), sidecar, indent=1)
+        return page_paths + [sidecar_path]
+
+    def sidecar(self, page_paths):
+        return {
+            "layout": self.layout,
+            "frame_size": list(self.frame_size),
+            "px_pad": self.px_pad,
+            "pages": [page_path.name for page_path in page_paths],
+            "slots": [
+                {
+                    "page": slot["page"],
+                    "x": slot["x"],
+                    "y": slot["y"],
+                    "w": slot["image"].width,
+                    "h": slot["image"].height,
+                    "offset": list(slot["offset"]),
+                }
+                for slot in self.slots
+            ],
+            "frames": self.frames,
+        }
+
+    def _outline(self, page_image, slots):
+        """frame the slots in their padding, lines for full and corners for dots"""
+        if self.outline_type == outline_types.none:
+            return
+        draw = ImageDraw.Draw(page_image)
+        for slot in slots:
+            if not slot["image"].width or not slot["image"].height:
+                continue
+            left = slot["x"] - self.px_pad
+            top = slot["y"] - self.px_pad
+            right = slot["x"] + slot["image"].width + self.px_pad - 1
+            bottom = slot["y"] + slot["image"].height + self.px_pad - 1
+            if self.outline_type == outline_types.full:
+                draw.rectangle((left, top, right, bottom), outline=self.odd_color)
+            elif self.outline_type == outline_types.dots:
+                for corner in [(left, top), (right, top), (left, bottom), (right, bottom)]:
+                    page_image.putpixel(corner, self.odd_color)
+
+
+class _MaxRectsPage:
+    """free space of one page for max rects packing, best short side fit"""
+
+    def __init__(self, width, height):
+        self.free = [(0, 0, width, height)]
+
+    def insert(self, width, height):
+        """place a rectangle, returns its (x, y) or None if it doesn't fit"""
+        best = None
+        for x, y, free_width, free_height in self.free:
+            if width <= free_width and height <= free_height:
+                leftover = sorted([free_width - width, free_height - height])
+                if best is None or leftover < best[0]:
+                    best = (leftover, x, y)
+        if best is None:
+            return None
+        self._split((best[1], best[2], width, height))
+        return best[1], best[2]
+
+    def _split(self, used):
+        used_x, used_y, used_width, used_height = used
+        free = []
+        for x, y, width, height in self.free:
+            if (
+                used_x >= x + width
+                or used_x + used_width <= x
+                or used_y >= y + height
+                or used_y + used_height <= y
+            ):
+                free.append((x, y, width, height))
+                continue
+            if used_x > x:
+                free.append((x, y, used_x - x, height))
+            if used_x + used_width < x + width:
+                free.append(
+                    (used_x + used_width, y, x + width - used_x - used_width, height)
+                )
+            if used_y > y:
+                free.append((x, y, width, used_y - y))
+            if used_y + used_height < y + height:
+                free.append(
+                    (x, used_y + used_height, width, y + height - used_y - used_height)
+                )
+        # drop free rectangles that sit inside another one
+        self.free = [
+            rect
+            for i, rect in enumerate(free)
+            if not any(
+                j != i
+                and other[0] <= rect[0]
+                and other[1] <= rect[1]
+                and other[0] + other[2] >= rect[0] + rect[2]
+                and other[1] + other[3] >= rect[1] + rect[3]
+                and (other != rect or j < i)
+                for j, other in enumerate(free)
+            )
+        ]
+
+
+Frame = collections.namedtuple("Frame", "image index duration disposal box")
+""" one composited frame from iterFrames, box is the region the frame updated
+"""
+
+
+def iterFrames(path, mode="auto", bg_color=(0, 0, 0, 0)):
+    """
+    Yield the composited frames of an animation one at a time as Frame tuples.
+    mode is "full", "partial" or "auto" to let analyseImage decide.
+    Frame.image is the compositor's canvas and changes when the next frame is
+    pulled, copy it to keep it. Only one frame is held in memory at a time.
+    """
+    if mode == "auto":
+        mode = analyseImage(path)["mode"]
+
+    with Image.open(path) as im:
+        p = im.getpalette()
+        compositor = GifCompositor(im.size, partial=(mode == "partial"), bg_color=bg_color)
+        index = 0
         while True:
+            # the tile is only there until the frame is loaded, getpalette loads it
+            box = im.tile[0][1] if im.tile else (0, 0) + im.size
             if not im.getpalette() and im.mode in ("L", "LA", "P", "PA"):
                 im.putpalette(p)
-            bg_color = (0, 0, 0, 0)  # (0, 0, 127, 255)
-            new_frame = Image.new("RGBA", im.size, bg_color)
-
-            if mode == "partial" and partial is None or partial:
-                new_frame.paste(last_frame)
+            disposal = getattr(im, "disposal_method", 0)
+            image = compositor.add(im, box, disposal)
+            yield Frame(image, index, im.info.get("duration", 0), disposal, box)
 
-            new_frame.paste(im, (0, 0), im.convert("RGBA"))
+            index += 1
+            try:
+                im.seek(im.tell() + 1)
+            except EOFError:
+                return
 
-            if texture:
-                x_offset = px_pad + i * (im.width + px_pad)
-                new_image.paste(new_frame, (x_offset, px_pad))
 
-            else:
-                new_path = (
-                    pathlib.Path(path).parent / f"{pathlib.Path(path).stem}-{i}.png"
+def writeSequence(path, frames, encoders=1, compress_level=6):
+    """
+    Save every frame as stem-i.png next to path, returns the files written.
+    With more than one encoder the frames are copied into a bounded queue and
+    compressed by a thread pool (PIL lets go of the GIL while zlib runs), so
+    decoding the next frames doesn't wait on the png encoder.
+    compress_level is zlib's 0-9, lower is faster and bigger.
+    """
+    new_files = []
+    if encoders <= 1:
+        for frame in frames:
+            new_files.append(_saveFrame(path, frame.index, frame.image, compress_level))
+        return new_files
+
+    with ThreadPoolExecutor(max_workers=encoders) as pool:
+        pending = collections.deque()
+        for frame in frames:
+            pending.append(
+                pool.submit(
+                    _saveFrame, path, frame.index, frame.image.copy(), compress_level
                 )
-                new_frame.save(new_path, "PNG")
-                new_files.append(new_path)
+            )
+            # a couple of frames queued per encoder, then wait for the oldest
+            while len(pending) >= encoders * 2:
+                new_files.append(pending.popleft().result())
+        new_files.extend(job.result() for job in pending)
+    return new_files
 
-            i += 1
-            good_job = i >= im.n_frames
 
-            last_frame = new_frame
-            im.seek(im.tell() + 1)
+def _saveFrame(path, index, image, compress_level=6):
+    new_path = pathlib.Path(path).parent / f"{pathlib.Path(path).stem}-{index}.png"
+    image.save(new_path, "PNG", compress_level=compress_level)
+    return new_path
 
-    except EOFError:
-        if good_job:
-            logging.debug("good job, we got all the frames")
-
-    if good_job and texture:
-        # outlining the texture frames
-        horizontal_bar = Image.new("RGBA", (new_size[0], 1), odd_color)
-        vertical_bar = Image.new("RGBA", (1, new_size[1]), odd_color)
-        # outline_type = outline_types.full
+
+def writeStripTexture(
+    new_path, frames, size, n_frames, outline_type, px_pad, odd_color
+):
+    """paste every frame into one row and save it, returns how many frames it got"""
+    new_size = (
+        px_pad + ((px_pad + size[0]) * n_frames),
+        size[1] + px_pad * 2,
+    )
+    new_image = Image.new("RGBA", new_size)
+    num_frames = 0
+    for frame in frames:
+        x_offset = px_pad + frame.index * (size[0] + px_pad)
+        new_image.paste(frame.image, (x_offset, px_pad))
+        num_frames += 1
+    if num_frames < n_frames:
+        return num_frames
+
+    # outlining the texture frames
+    horizontal_bar = Image.new("RGBA", (new_size[0], 1), odd_color)
+    vertical_bar = Image.new("RGBA", (1, new_size[1]), odd_color)
+    # outline_type = outline_types.full
+    if outline_type == outline_types.full:
+        new_image.paste(horizontal_bar, (0, 0))
+        new_image.paste(horizontal_bar, (0, new_size[1] - 1))
+
+    for i in range(n_frames + 1):
+        x_offset = px_pad + i * (size[0] + px_pad)
         if outline_type == outline_types.full:
-            new_image.paste(horizontal_bar, (0, 0))
-            new_image.paste(horizontal_bar, (0, new_size[1] - 1))
+            new_image.paste(vertical_bar, (x_offset - px_pad, px_pad))
+        elif outline_type == outline_types.dots:
+            for y_val in [0, new_size[1] - 1]:
+                new_image.putpixel((x_offset - px_pad, y_val), odd_color)
+        # new_image.paste(vertical_bar, (x_offset, new_size[1] - 1))
+
+    # saving the texture
+    logging.debug(new_path)
+    new_image.save(new_path, "PNG")
+    return num_frames
+
 
-        for i in range(im.n_frames + 1):
-            x_offset = px_pad + i * (im.width + px_pad)
-            if outline_type == outline_types.full:
-                new_image.paste(vertical_bar, (x_offset - px_pad, px_pad))
-            elif outline_type == outline_types.dots:
-                for y_val in [0, new_size[1] - 1]:
-                    new_image.putpixel((x_offset - px_pad, y_val), odd_color)
-            # new_image.paste(vertical_bar, (x_offset, new_size[1] - 1))
+def processImageToTexture(
+    path,
+    partial=None,
+    texture=True,
+    outline_type=outline_types.none,
+    px_pad=1,
+    odd_color=(2, 210, 69, 255),
+    layout="strip",
+    max_size=(4096, 4096),
+    encoders=1,
+    compress_level=6,
+):
+    """the same as the last one but it makes a texture instead of a sequence of images
+    layout "strip" puts every frame in one row, "grid" and "maxrects" build a
+    TextureAtlas with a json sidecar instead
+    encoders and compress_level are for the sequence of images
+    """
+    mode = "auto" if partial is None else "partial" if partial else "full"
+    bg_color = (0, 0, 0, 0)  # (0, 0, 127, 255)
+    with Image.open(path) as im:
+        size = im.size
+        n_frames = getattr(im, "n_frames", 1)
+
+    frames = iterFrames(path, mode, bg_color)
+    new_path = pathlib.Path(path).parent / f"{pathlib.Path(path).stem}_texture.png"
+    new_files = []
+    if not texture:
+        new_files = writeSequence(path, frames, encoders, compress_level)
+        num_frames = len(new_files)
+    elif layout == "strip":
+        num_frames = writeStripTexture(
+            new_path, frames, size, n_frames, outline_type, px_pad, odd_color
+        )
+        if num_frames >= n_frames:
+            new_files.append(new_path)
+    else:
+        atlas = TextureAtlas(layout, max_size, px_pad, outline_type, odd_color)
+        for frame in frames:
+            atlas.add(frame.image, frame.duration)
+        num_frames = len(atlas.frames)
+        if num_frames >= n_frames:
+            new_files.extend(atlas.save(new_path))
+
+    if num_frames >= n_frames:
+        logging.debug("good job, we got all the frames")
+    return new_files
+
+
+class GifBatch:
+    """
+    Convert every animation matched by a list of directories and globs in a
+    process pool. Still images and the stem-N.png frames of a --seq run are
+    left alone. A file is skipped when its _texture.png is newer than it, or
+    when the manifest says a file with the same content hash was already
+    converted with the same options and its outputs are still there.
+    """
 
-        # saving the texture
-        new_path = pathlib.Path(path).parent / f"{pathlib.Path(path).stem}_texture.png"
+    suffixes = {".gif", ".png", ".webp"}
+
+    def __init__(self, inputs, workers=None, manifest_path=_manifest_path, **options):
+        self.inputs = inputs
+        self.workers = workers
+        self.manifest_path = pathlib.Path(manifest_path)
+        self.options = options
+        self.manifest = {}
+
+    def main(self):
+        self._load_manifest()
+        todo, num_skipped = self.collect()
+
+        num_files = 0
+        num_frames = 0
+        num_bytes = 0
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            jobs = {
+                pool.submit(_convertFile, str(path), self.options): (path, key)
+                for path, key in todo
+            }
+            for job in as_completed(jobs):
+                path, key = jobs[job]
+                try:
+                    new_files, frames, seconds = job.result()
+                except Exception as err:
+                    print(f"failed {path}: {err}")
+                    continue
+                print(f"{path}: {frames} frames in {seconds:.2f}s")
+                num_files += 1
+                num_frames += frames
+                num_bytes += path.stat().st_size
+                self.manifest[str(path.resolve())] = {
+                    "key": key,
+                    "outputs": [os.path.abspath(new_file) for new_file in new_files],
+                }
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        self._save_manifest()
+
+        print(f"{num_files} files in {elapsed:.2f}s ({num_skipped} up to date)")
+        print(
+            f"{num_files / elapsed:.2f} files/s, {num_frames / elapsed:.1f} frames/s,"
+            f" {num_bytes / elapsed / 2 ** 20:.2f} MB/s"
+        )
 
-        logging.debug(new_path)
-        new_image.save(new_path, "PNG")
-        new_files.append(new_path)
+    def collect(self):
+        """return the (path, manifest key) pairs to convert and how many were skipped"""
+        paths = []
+        for pattern in self.inputs:
+            if os.path.isdir(pattern):
+                matches = sorted(pathlib.Path(pattern).iterdir())
+            else:
+                matches = [pathlib.Path(match) for match in sorted(glob.glob(pattern))]
+            paths.extend(
+                path
+                for path in matches
+                if path.suffix.lower() in self.suffixes
+                and path.is_file()
+                and not path.stem.endswith("_texture")
+            )
+
+        # frames written by earlier --seq runs are outputs, not animations
+        outputs = {
+            os.path.abspath(output)
+            for entry in self.manifest.values()
+            for output in entry["outputs"]
+        }
+        options = json.dumps(self.options, sort_keys=True, default=str)
+        todo = []
+        num_skipped = 0
+        for path in dict.fromkeys(paths):
+            if os.path.abspath(path) in outputs or self._is_frame(path):
+                continue
+            if not self._is_animated(path):
+                continue
+            texture = path.parent / f"{path.stem}_texture.png"
+            if (
+                self.options.get("texture", True)
+                and texture.exists()
+                and texture.stat().st_mtime >= path.stat().st_mtime
+            ):
+                num_skipped += 1
+                continue
+            with open(path, "rb") as image_file:
+                key = hashlib.sha256(image_file.read() + options.encode()).hexdigest()
+            entry = self.manifest.get(str(path.resolve()), {})
+            if entry.get("key") == key and all(
+                os.path.exists(output) for output in entry["outputs"]
+            ):
+                num_skipped += 1
+                continue
+            todo.append((path, key))
+        return todo, num_skipped
+
+    def _is_frame(self, path):
+        """whether path is stem-N.png next to an animation called stem"""
+        stem, _, index = path.stem.rpartition("-")
+        if path.suffix.lower() != ".png" or not stem or not index.isdecimal():
+            return False
+        return any(path.with_name(stem + suffix).exists() for suffix in self.suffixes)
+
+    @staticmethod
+    def _is_animated(path):
+        try:
+            with Image.open(path) as im:
+                return getattr(im, "is_animated", False)
+        except OSError:
+            return False
+
+    def _load_manifest(self):
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+    def _save_manifest(self):
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.manifest_path, "w") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=1)
+
+
+def _convertFile(path, options):
+    """processImageToTexture in a pool worker, returns (files, frames, seconds)"""
+    start = time.perf_counter()
+    options = dict(options)
+    options["outline_type"] = outline_types[options["outline_type"]]
+    new_files = processImageToTexture(path, **options)
+    with Image.open(path) as im:
+        frames = getattr(im, "n_frames", 1)
+    return new_files, frames, time.perf_counter() - start
 
 
 test_img = "E:\\files\\cod\\vandal5\\src\\vandal5\\artassets\\crit_slash.gif"
 
 
 def main(args):
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    if args.batch:
+        GifBatch(
+            args.batch,
+            workers=args.workers,
+            partial=args.partial,
+            texture=(not args.seq),
+            outline_type=args.outline,
+            layout=args.layout,
+            max_size=(args.max_size, args.max_size),
+            # the pool already keeps every core busy
+            encoders=1,
+            compress_level=args.compress,
+        ).main()
+        return
     processImageToTexture(
         args.image,
         partial=args.partial,
         texture=(not args.seq),
         outline_type=outline_types[args.outline],
+        layout=args.layout,
+        max_size=(args.max_size, args.max_size),
+        encoders=args.encoders,
+        compress_level=args.compress,
     )
-    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
 
 
 def parse_args(args_):
@@ -187,6 +813,52 @@ def parse_args(args_):
         help="outline type",
         choices=["full", "dots", "none"],
     )
+    parser.add_argument(
+        "-l",
+        "--layout",
+        type=str,
+        default="strip",
+        help="texture layout, grid and maxrects drop duplicate frames and write a json sidecar",
+        choices=["strip", "grid", "maxrects"],
+    )
+    parser.add_argument(
+        "-m",
+        "--max-size",
+        type=int,
+        default=4096,
+        help="largest texture page width and height for grid and maxrects",
+    )
+    parser.add_argument(
+        "-e",
+        "--encoders",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="threads encoding pngs for --seq while frames are decoded",
+    )
+    parser.add_argument(
+        "-c",
+        "--compress",
+        type=int,
+        default=6,
+        choices=range(10),
+        metavar="0-9",
+        help="png compression level for --seq, lower is faster",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        type=str,
+        nargs="+",
+        default=None,
+        help="directories or globs of animations to convert, skips ones already done",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="processes converting files with --batch, defaults to one per cpu",
+    )
     return parser.parse_args(args_)
 
 
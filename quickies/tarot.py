@@ -1,22 +1,25 @@
 #! /usr/bin/env python
 import sys
+import os
 import math
 import time
 import random
-from rich.console import Console
-from rich.layout import Layout
-from rich.text import Text
-from rich.live import Live
-import pprint
+import heapq
 import json
+import marshal
+import hashlib
 import pathlib
 import argparse
-import logging
 from Fuzzy import fuzzy_string_comparison, normalize_string
 
+# rich, pprint and subprocess are imported by the modes that use them,
+# importing them up front was most of the startup time
+
 arcana_path = pathlib.Path(__file__).parent / "arcana.json"
+_snapshot_dir = pathlib.Path.home().joinpath(".cache", "cool_cli_stuff", "tarot")
 _CARDS_DATA = None
-CARDS = {}
+_CARDS = None
+_CARD_INDEX = None
 
 
 class MajorArcana:
@@ -65,43 +68,642 @@ class MajorArcana:
         }
 
 
-with open(arcana_path, "r") as arcana_file:
-    _CARDS_DATA = json.load(arcana_file)["major arcana"]
+def load_cards_data(path=arcana_path):
+    """the card dicts in arcana.json, read through a marshal snapshot of the parsed json
+    the snapshot keeps the json's mtime, size and sha256. it's used without reading the
+    json while mtime and size match, and only re-parsed if the content hash changed
+    """
+    path = pathlib.Path(path)
+    stat = path.stat()
+    path_key = hashlib.sha1(str(path.resolve()).encode()).hexdigest()[:8]
+    snapshot_path = _snapshot_dir.joinpath(f"{path.stem}_{path_key}.marshal")
+    snapshot = None
+    try:
+        with open(snapshot_path, "rb") as snapshot_file:
+            snapshot = marshal.load(snapshot_file)
+        if snapshot[:2] == (stat.st_mtime_ns, stat.st_size):
+            return snapshot[3]
+    except (OSError, EOFError, ValueError, TypeError):
+        snapshot = None
+
+    with open(path, "rb") as arcana_file:
+        raw = arcana_file.read()
+    sha = hashlib.sha256(raw).hexdigest()
+    if snapshot is not None and snapshot[2] == sha:
+        data = snapshot[3]
+    else:
+        data = json.loads(raw)["major arcana"]
+    try:
+        _snapshot_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = snapshot_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as snapshot_file:
+            marshal.dump((stat.st_mtime_ns, stat.st_size, sha, data), snapshot_file)
+        os.replace(tmp_path, snapshot_path)
+    except OSError:
+        pass
+    return data
+
+
+def get_cards():
+    """lowercase name -> MajorArcana for every card, loaded the first time it's needed"""
+    global _CARDS_DATA, _CARDS
+    if _CARDS is None:
+        _CARDS_DATA = load_cards_data()
+        _CARDS = {card["name"].lower(): MajorArcana(**card) for card in _CARDS_DATA}
+    return _CARDS
+
+
+def __getattr__(name):
+    """tarot.CARDS still works from outside, it loads the cards on first access"""
+    if name == "CARDS":
+        return get_cards()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class CardIndex:
+    """lookups into a deck of cards built once
+    numbers go through a list, exact names through a dict of normalized names,
+    partial names through a prefix trie and anything else is ranked by fuzzy score.
+    names are indexed with and without a leading "the" so "tower" finds The Tower.
+    only the fuzzy fallback looks at every name
+    """
+
+    fuzzy_threshold = 0.6
+
+    def __init__(self, cards):
+        self.cards = list(cards)
+        numbers = [card.number for card in self.cards if isinstance(card.number, int)]
+        self.by_number = [None] * (max(numbers, default=-1) + 1)
+        self.by_name = {}
+        # nodes are [children, (key length, card id)], every node lists the cards
+        # below it already ranked, shortest name first, so a prefix lookup is a slice
+        self.trie = [{}, []]
+        for card_id, card in enumerate(self.cards):
+            if isinstance(card.number, int) and self.by_number[card.number] is None:
+                self.by_number[card.number] = card
+            for key in self.name_keys(card.name):
+                self.by_name.setdefault(key, card_id)
+                self._trie_insert(key, card_id)
+        self._trie_rank(self.trie)
+
+    @staticmethod
+    def name_keys(name):
+        """the normalized names a card is found by"""
+        key = normalize_string(name)
+        keys = [key]
+        if key.startswith("the") and len(key) > 3:
+            keys.append(key[3:])
+        return keys
+
+    def _trie_insert(self, key, card_id):
+        node = self.trie
+        for char in key:
+            node = node[0].setdefault(char, [{}, []])
+            node[1].append((len(key), card_id))
+
+    def _trie_rank(self, root):
+        """sort every node's cards by key length then deck position, one per card"""
+        nodes = [root]
+        while nodes:
+            node = nodes.pop()
+            nodes.extend(node[0].values())
+            seen = set()
+            ranked = []
+            for key_length, card_id in sorted(node[1]):
+                if card_id not in seen:
+                    seen.add(card_id)
+                    ranked.append((key_length, card_id))
+            node[1] = ranked
+
+    def get_by_number(self, number):
+        if 0 <= number < len(self.by_number):
+            return self.by_number[number]
+        return None
+
+    def get(self, query):
+        """the best match for a number or name, None if nothing is close"""
+        candidates = self.lookup(query, limit=1)
+        return candidates[0][0] if candidates else None
+
+    def lookup(self, query, limit=5):
+        """up to limit (card, score) pairs for a number or name, best first
+        exact numbers and names score 1.0, prefixes score by how much of the
+        name they cover and the rest fall back to the fuzzy comparison.
+        a prefix costs its length plus limit, however many cards are under it
+        """
+        query = str(query).strip()
+        if query.isdecimal():
+            card = self.get_by_number(int(query))
+            return [(card, 1.0)] if card is not None else []
+        key = normalize_string(query)
+        if not key:
+            return []
+        if key in self.by_name:
+            return [(self.cards[self.by_name[key]], 1.0)]
+
+        node = self.trie
+        for char in key:
+            node = node[0].get(char)
+            if node is None:
+                break
+        else:
+            return [
+                (self.cards[card_id], len(key) / key_length)
+                for key_length, card_id in node[1][:limit]
+            ]
+
+        return self._ranked(self._fuzzy_scores(key), limit)
+
+    def _fuzzy_scores(self, key):
+        """(similarity, card id) for every name at least fuzzy_threshold similar
+        same as difflib.get_close_matches, the quick upper bounds skip most names
+        """
+        import difflib
+
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(key)
+        for name_key, card_id in self.by_name.items():
+            matcher.set_seq1(name_key)
+            if (
+                matcher.real_quick_ratio() >= self.fuzzy_threshold
+                and matcher.quick_ratio() >= self.fuzzy_threshold
+                and matcher.ratio() >= self.fuzzy_threshold
+            ):
+                yield matcher.ratio(), card_id
+
+    def _ranked(self, scored, limit):
+        """the best limit (card, score) pairs by score, then by position in the deck"""
+        best = {}
+        for score, card_id in scored:
+            if score > best.get(card_id, -1.0):
+                best[card_id] = score
+        return [
+            (self.cards[card_id], score)
+            for card_id, score in heapq.nsmallest(
+                limit, best.items(), key=lambda item: (-item[1], item[0])
+            )
+        ]
+
+
+def get_card_index():
+    """the CardIndex of the major arcana, built the first time it's needed"""
+    global _CARD_INDEX
+    if _CARD_INDEX is None:
+        _CARD_INDEX = CardIndex(get_cards().values())
+    return _CARD_INDEX
+
+
+class DrawnCard:
+    """a card as it came out of a deck, the reversal belongs to the draw
+    anything else is read from the card, so it can be used like a MajorArcana
+    """
+
+    __slots__ = ("card", "is_reverse")
+
+    def __init__(self, card, is_reverse=False) -> None:
+        self.card = card
+        self.is_reverse = is_reverse
+
+    def __getattr__(self, name):
+        # card itself and dunders aren't forwarded, copy and pickle look them up
+        # on an instance before its slots are filled
+        if name == "card" or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.card, name)
+
+    def __repr__(self):
+        reverse_text = " (reversed)" if self.is_reverse else ""
+        return f"<DrawnCard {self.card.name}{reverse_text}>"
 
-    for card in _CARDS_DATA:
-        new_card = MajorArcana(**card)
-        CARDS[card["name"].lower()] = new_card
+    @property
+    def reading(self):
+        return self.card.reversed if self.is_reverse else self.card.upright
 
 
 class ArcanaDeck:
+    """a shuffled deck that deals without replacement
+    the deck is a list of indices into cards shuffled once (fisher-yates), so a draw
+    is a pop off the end. decks never change the cards, any number of them can share
+    the same cards. copies > 1 makes a shoe of that many decks shuffled together
+    """
+
     reverse_odds = 0.3
 
-    def __init__(self) -> None:
-        self.cards_in_deck = [card for card in CARDS.values()]
+    def __init__(self, cards=None, copies=1, seed=None, reverse_odds=None) -> None:
+        self.cards = list(get_cards().values() if cards is None else cards)
+        self.copies = copies
+        self.rng = random.Random(seed)
+        if reverse_odds is not None:
+            self.reverse_odds = reverse_odds
+        self.order = []
+        self.cards_played = []
+        self.shuffle()
+
+    @classmethod
+    def shoe(cls, num_decks, **kwargs):
+        """num_decks copies of the deck shuffled together"""
+        return cls(copies=num_decks, **kwargs)
+
+    def shuffle(self):
+        """put every card back and shuffle"""
+        self.order = list(range(len(self.cards))) * self.copies
+        order = self.order
+        for i in range(len(order) - 1, 0, -1):
+            j = self.rng.randrange(i + 1)
+            order[i], order[j] = order[j], order[i]
         self.cards_played = []
 
+    @property
+    def cards_in_deck(self):
+        """the cards left, the next one to be drawn last"""
+        return [self.cards[i] for i in self.order]
+
+    def __len__(self):
+        return len(self.order)
+
     def draw(self):
-        card = random.choice(self.cards_in_deck)
-        card.is_reverse = random.random() < self.reverse_odds
-        self.cards_in_deck.remove(card)
+        if not self.order:
+            raise IndexError("the deck is empty")
+        card = DrawnCard(
+            self.cards[self.order.pop()], self.rng.random() < self.reverse_odds
+        )
         self.cards_played.append(card)
         return card
 
+    def draw_many(self, num_cards):
+        return [self.draw() for _ in range(num_cards)]
 
-class TarotRunner:
-    def __init__(self) -> None:
-        self.deck = ArcanaDeck()
-        self.qa_pairs = [
-            (self._quiz_get_name, self._quiz_get_number),
-            (self._quiz_get_upright, self._quiz_get_name),
-        ]
-        self._blank_enty_pairs = [
-            (self._quiz_get_name, self._quiz_get_number),
-            (self._quiz_get_upright, self._quiz_get_name_normalized),
+
+class SpreadSimulator:
+    """deal millions of spreads at once with numpy to check the odds empirically
+    every spread is dealt from a full deck: a batch of spreads is the first
+    spread_size columns of a batch of random permutations, and reversals are a
+    bernoulli array with the deck's reverse_odds. workers split the spreads over
+    processes, each with its own stream spawned from one seed
+    """
+
+    batch_size = 1 << 16
+
+    def __init__(self, cards=None, spread_size=3, reverse_odds=None, seed=None):
+        self.cards = list(get_cards().values() if cards is None else cards)
+        self.spread_size = spread_size
+        self.reverse_odds = (
+            ArcanaDeck.reverse_odds if reverse_odds is None else reverse_odds
+        )
+        self.seed = seed
+        if not 0 < spread_size <= len(self.cards):
+            raise ValueError(f"spread size must be between 1 and {len(self.cards)}")
+
+    def simulate(self, num_spreads, workers=1):
+        """return the counts from dealing num_spreads spreads, see _simulate_counts"""
+        import numpy as np
+
+        streams = np.random.SeedSequence(self.seed).spawn(max(1, workers))
+        shares = [num_spreads // len(streams)] * len(streams)
+        shares[0] += num_spreads - sum(shares)
+        jobs = [
+            (len(self.cards), self.spread_size, self.reverse_odds, share, stream)
+            for share, stream in zip(shares, streams)
         ]
-        self.fuzzy_comparison_threshold = 0.8
+        if workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_simulate_counts, *zip(*jobs)))
+        else:
+            results = [_simulate_counts(*job) for job in jobs]
+        counts = {key: sum(result[key] for result in results) for key in results[0]}
+        counts["spreads"] = num_spreads
+        return counts
+
+    def exact(self):
+        """the exact probabilities the frequencies should approach"""
+        n, k, p = len(self.cards), self.spread_size, self.reverse_odds
+        appears = math.comb(n - 1, k - 1) / math.comb(n, k)
+        return {
+            "appears": appears,
+            "reversed": appears * p,
+            "position": 1 / n,
+            "pair": math.comb(n - 2, k - 2) / math.comb(n, k) if k > 1 else 0.0,
+        }
+
+    def report(self, counts, card=None):
+        """print the simulated frequencies next to the exact ones"""
+        import numpy as np
+
+        num_spreads = counts["spreads"]
+        exact = self.exact()
+        appears = counts["appears"] / num_spreads
+        reversed_ = counts["reversed"] / num_spreads
+        position = counts["position"] / num_spreads
+        pair = counts["pair"] / num_spreads
+
+        print(
+            f"{num_spreads:,} spreads of {self.spread_size} from {len(self.cards)} cards,"
+            f" reverse odds {self.reverse_odds}"
+        )
+        positions = "".join(f"{f'pos {i + 1}':>9}" for i in range(self.spread_size))
+        print(f"{'card':<20}{'appears':>9}{'reversed':>9}{positions}")
+        print(
+            f"{'exact':<20}{exact['appears']:9.5f}{exact['reversed']:9.5f}"
+            + f"{exact['position']:9.5f}" * self.spread_size
+        )
+        for i, this_card in enumerate(self.cards):
+            print(
+                f"{this_card.name[:19]:<20}{appears[i]:9.5f}{reversed_[i]:9.5f}"
+                + "".join(f"{position[j, i]:9.5f}" for j in range(self.spread_size))
+            )
+
+        if self.spread_size > 1:
+            off_diagonal = ~np.eye(len(self.cards), dtype=bool)
+            worst = np.abs(pair - exact["pair"]) * off_diagonal
+            a, b = np.unravel_index(worst.argmax(), worst.shape)
+            print(
+                f"pairs: exact {exact['pair']:.5f}, simulated"
+                f" {pair[off_diagonal].min():.5f} to {pair[off_diagonal].max():.5f},"
+                f" furthest {self.cards[a].name} + {self.cards[b].name}"
+                f" at {pair[a, b]:.5f}"
+            )
+        # most differences from exact should be within a couple of standard errors
+        error = math.sqrt(exact["appears"] * (1 - exact["appears"]) / num_spreads)
+        print(
+            f"largest appears difference {np.abs(appears - exact['appears']).max():.5f},"
+            f" standard error {error:.5f}"
+        )
+
+        if card is not None:
+            i = self.cards.index(card)
+            print(
+                f"{card.name}: in {appears[i]:.4%} of spreads (exact"
+                f" {exact['appears']:.4%}), reversed in {reversed_[i]:.4%} (exact"
+                f" {exact['reversed']:.4%})"
+            )
+
+
+def _simulate_counts(num_cards, spread_size, reverse_odds, num_spreads, seed):
+    """deal num_spreads spreads in batches and count
+    appears[card], reversed[card], position[position, card] and pair[card, card]
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    appears = np.zeros(num_cards, dtype=np.int64)
+    reversed_ = np.zeros(num_cards, dtype=np.int64)
+    position = np.zeros((spread_size, num_cards), dtype=np.int64)
+    pair = np.zeros((num_cards, num_cards), dtype=np.int64)
+    offsets = (np.arange(spread_size) * num_cards)[None, :]
+    batch_size = SpreadSimulator.batch_size
+    for start in range(0, num_spreads, batch_size):
+        batch = min(batch_size, num_spreads - start)
+        spreads = rng.random((batch, num_cards)).argsort(axis=1)[:, :spread_size]
+        is_reverse = rng.random((batch, spread_size)) < reverse_odds
+        appears += np.bincount(spreads.ravel(), minlength=num_cards)
+        reversed_ += np.bincount(spreads[is_reverse], minlength=num_cards)
+        position += np.bincount(
+            (spreads + offsets).ravel(), minlength=spread_size * num_cards
+        ).reshape(spread_size, num_cards)
+        for i in range(spread_size):
+            for j in range(i + 1, spread_size):
+                pair += np.bincount(
+                    spreads[:, i] * num_cards + spreads[:, j],
+                    minlength=num_cards * num_cards,
+                ).reshape(num_cards, num_cards)
+    pair += pair.T
+    return {
+        "appears": appears,
+        "reversed": reversed_,
+        "position": position,
+        "pair": pair,
+    }
+
+
+class QuizQuestion:
+    """one quiz question, everything needed to ask it and to grade an answer to it"""
+
+    __slots__ = ("id", "mode", "card", "prompt", "choices", "answer", "answer_index")
+
+    def __init__(
+        self, id, mode, card, prompt, answer, choices=None, answer_index=None
+    ) -> None:
+        self.id = id
+        self.mode = mode
+        self.card = card
+        self.prompt = prompt
+        self.answer = answer
+        self.choices = choices
+        self.answer_index = answer_index
+
+    def get_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{name: data.get(name) for name in cls.__slots__})
+
+
+class QuizAnswer:
+    """a response to a question, either typed text or the 1 based number of a choice
+    text answering a multiple choice question is compared with the choices' text,
+    so "0" is the answer 0 rather than a choice number
+    """
+
+    __slots__ = ("text", "choice")
+
+    def __init__(self, text=None, choice=None) -> None:
+        self.text = text
+        self.choice = choice
+
+    def get_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class QuizGrade:
+    """the result of grading an answer, matches and unmatched are for meaning questions"""
+
+    __slots__ = ("question_id", "is_correct", "expected", "matches", "unmatched")
+
+    def __init__(self, question_id, is_correct, expected, matches=0, unmatched=()):
+        self.question_id = question_id
+        self.is_correct = is_correct
+        self.expected = expected
+        self.matches = matches
+        self.unmatched = list(unmatched)
+
+    def get_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class QuizEngine:
+    """makes quiz questions and grades answers without any input or output
+    questions come from a deck of its own that's reshuffled when it runs low,
+    so a seeded engine asks the same questions in the same order
+    """
+
+    # (question field, answer field) for multiple choice, either way around
+    qa_pairs = [("name", "number"), ("upright", "name")]
+    blank_entry_pairs = [("name", "number"), ("upright", "name_normalized")]
+    mode_weights = {"multiple choice": 2, "blank entry": 1, "meaning": 1}
+    num_choices = 4
+    fuzzy_comparison_threshold = 0.8
+    meaning_fuzz_threshold = 0.55
+    meaning_matches_to_score = 2
+
+    def __init__(self, cards=None, seed=None) -> None:
+        self.deck = ArcanaDeck(cards, seed=seed)
+        self.rng = self.deck.rng
+        self.num_questions = 0
+
+    def field(self, card, name):
+        """the value of a card a question asks about, as a string"""
+        if name == "name_normalized":
+            return normalize_string(card.name.replace("The ", " "))
+        return str(getattr(card, name))
+
+    def choose_mode(self):
+        modes = list(self.mode_weights)
+        return self.rng.choices(modes, weights=list(self.mode_weights.values()))[0]
+
+    def next_question(self):
+        mode = self.choose_mode()
+        # reshuffle before the question so its choices are never the same card twice
+        if len(self.deck) < self.num_choices:
+            self.deck.shuffle()
+        card = self.deck.draw()
+        self.num_questions += 1
+        question_id = self.num_questions
+        if mode == "multiple choice":
+            question_field, answer_field = self.rng.choice(self.qa_pairs)
+            if self.rng.random() < 0.5:
+                question_field, answer_field = answer_field, question_field
+            choices = self.deck.draw_many(self.num_choices - 1)
+            choices.append(card)
+            self.rng.shuffle(choices)
+            return QuizQuestion(
+                question_id,
+                mode,
+                card.name,
+                self.field(card, question_field),
+                self.field(card, answer_field),
+                choices=[self.field(choice, answer_field) for choice in choices],
+                answer_index=choices.index(card),
+            )
+        if mode == "blank entry":
+            question_field, answer_field = self.rng.choice(self.blank_entry_pairs)
+            return QuizQuestion(
+                question_id,
+                mode,
+                card.name,
+                self.field(card, question_field),
+                self.field(card, answer_field),
+            )
+        return QuizQuestion(
+            question_id,
+            mode,
+            card.name,
+            "Please say atleast 2 things the following card represents,"
+            f" comma separated.\n\t{card.name}\n",
+            card.upright,
+        )
+
+    def grade(self, question, answer):
+        """grade a QuizAnswer to a QuizQuestion, returns a QuizGrade"""
+        response = "" if answer.text is None else str(answer.text)
+        if question.mode == "multiple choice":
+            if answer.choice is not None:
+                index = int(answer.choice) - 1
+                if not 0 <= index < len(question.choices):
+                    return QuizGrade(question.id, False, question.answer)
+                response = question.choices[index]
+            is_correct = response.strip() == question.answer
+            return QuizGrade(question.id, is_correct, question.answer)
+
+        if question.mode == "blank entry":
+            is_correct = bool(response.strip()) and (
+                self.fuzzy_comparison_threshold
+                < fuzzy_string_comparison(response, question.answer)
+            )
+            return QuizGrade(question.id, is_correct, question.answer)
+
+        meanings = question.answer.split(",")
+        matches = 0
+        for thing in response.split(","):
+            if not normalize_string(thing):
+                continue
+            for meaning in meanings:
+                if fuzzy_string_comparison(thing, meaning) > self.meaning_fuzz_threshold:
+                    matches += 1
+                    meanings.remove(meaning)
+                    break
+        return QuizGrade(
+            question.id,
+            matches >= self.meaning_matches_to_score,
+            question.answer,
+            matches,
+            [meaning.strip() for meaning in meanings],
+        )
+
+    def grade_stream(self, lines):
+        """yield (question, answer, grade) for each line of answers
+        a line is either a json object with a "text" or a "choice" number, or just
+        the text answering the engine's next question. a json line can carry its
+        own "question" (as from QuizQuestion.get_dict) instead of the next one
+        """
+        for line in lines:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            if line.lstrip().startswith("{"):
+                data = json.loads(line)
+                if "question" in data:
+                    question = QuizQuestion.from_dict(data["question"])
+                else:
+                    question = self.next_question()
+                answer = QuizAnswer(data.get("text"), data.get("choice"))
+            else:
+                question = self.next_question()
+                answer = QuizAnswer(line)
+            yield question, answer, self.grade(question, answer)
+
+    def benchmark(self, num_questions=100_000):
+        """time making and grading num_questions questions
+        every other answer is the right one, the rest are a wrong choice or a
+        misspelt version of the answer
+        """
+        start = time.perf_counter()
+        questions = [self.next_question() for _ in range(num_questions)]
+        made = time.perf_counter()
+        num_correct = 0
+        for i, question in enumerate(questions):
+            if question.mode == "multiple choice":
+                choice = question.answer_index + 1
+                if i % 2:
+                    choice = choice % len(question.choices) + 1
+                answer = QuizAnswer(choice=choice)
+            else:
+                answer = QuizAnswer(
+                    question.answer if i % 2 == 0 else question.answer[::-1]
+                )
+            num_correct += self.grade(question, answer).is_correct
+        graded = time.perf_counter()
+        print(
+            f"{num_questions:,} questions: made in {made - start:.2f}s"
+            f" ({num_questions / (made - start):,.0f}/s), graded in"
+            f" {graded - made:.2f}s ({num_questions / (graded - made):,.0f}/s),"
+            f" {num_correct:,} correct"
+        )
+        return num_correct
+
+
+class TarotRunner:
+    def __init__(self, seed=None) -> None:
+        self.deck = ArcanaDeck(seed=seed)
+        self.quiz = QuizEngine(seed=seed)
 
     def reading_main(self):
+        from rich.console import Console
+        from rich.layout import Layout
+        from rich.live import Live
+
         console = Console()
         console.height = 10
         layout = Layout()
@@ -120,15 +722,17 @@ class TarotRunner:
     def info_main(self, *args):
         for arg in args:
             card = self.get(arg)
-            self._print_card_info(card)
+            if card is not None:
+                self._print_card_info(card)
 
     def get(self, thing):
-        if str(thing).isnumeric():
+        if str(thing).isdecimal():
             return self._get_by_int(int(thing))
         else:
             return self._get_by_name(thing)
 
     def quiz_main(self, num_questions=1):
+        """ask num_questions questions in the terminal, the quiz engine does the rest"""
         num_correct = 0
         for _ in range(num_questions):
             if self._quiz_question():
@@ -136,131 +740,39 @@ class TarotRunner:
         print(f"You got {num_correct} out of {num_questions} correct")
 
     def _quiz_question(self):
-        """print name, provide random choices, ask for answer, return True/False"""
-        question_func, answer_func, mode = self._quiz_get_qa_pair()
-        is_correct = False
-        if mode == "multiple choice":
-            is_correct = self._quiz_multiple_choice_question(question_func, answer_func)
-        elif mode == "blank entry":
-            is_correct = self._quiz_blank_entry_question(question_func, answer_func)
-        else:
-            is_correct = self._quiz_say_upright_question()
-        return is_correct
-
-    def choose_mode(self):
-        mc_weight = 2
-        fill_in_weight = 1
-        meaning_weight = 1
-        sum_weights = mc_weight + fill_in_weight + meaning_weight
-        mc_odds = mc_weight / sum_weights
-        fill_in_odds = fill_in_weight / sum_weights
-        meaning_odds = meaning_weight / sum_weights
-        mode = None
-        random_num = random.random()
-        if random_num < mc_odds:
-            mode = "multiple choice"
-        elif random_num < mc_odds + fill_in_odds:
-            mode = "blank entry"
+        """print a question, read the answer and say if it was right, return True/False"""
+        question = self.quiz.next_question()
+        print(question.prompt)
+        if question.mode == "multiple choice":
+            for i, choice in enumerate(question.choices):
+                print(f"{i + 1}: {choice}")
+            print("please enter the # of the correct answer?")
+            answer = QuizAnswer(choice=self._quiz_get_num_input(len(question.choices)))
         else:
-            mode = "meaning"
-        return mode
+            answer = QuizAnswer(self._quiz_get_str_input())
+        grade = self.quiz.grade(question, answer)
 
-    def _quiz_get_qa_pair(self):
-        question_func, answer_func = None, None
-        reverse_odds = 0.5
-        mode = self.choose_mode()
-        if mode == "multiple choice":
-            func_a, func_b = random.choice(self.qa_pairs)
-            reverse_qa = random.random() < reverse_odds
-            question_func = func_a if not reverse_qa else func_b
-            answer_func = func_b if not reverse_qa else func_a
-        elif mode == "blank entry":
-            question_func, answer_func = random.choice(self._blank_enty_pairs)
-        else:
-            question_func = None
-            answer_func = None
-        return question_func, answer_func, mode
-
-    def _quiz_multiple_choice_question(self, question_func, answer_func):
-        card = self._draw()
-        print(question_func(card))
-        choices = [self._draw() for _ in range(3)]
-        choices.append(card)
-        random.shuffle(choices)
-        enumerated_choices = list(choices)
-        for i, choice in enumerate(choices):
-            print(f"{i + 1}: {answer_func(choice)}")
-        print("please enter the # of the correct answer?")
-        answer = self._quiz_get_num_input()
-        answer_index = int(answer) - 1
-        correct_value = answer_func(card)
-        correct_number_val = choices.index(card) + 1
-        chosen_value = answer_func(enumerated_choices[answer_index])
-
-        is_correct = chosen_value == correct_value
-        if is_correct:
+        if grade.is_correct:
             print("Correct!")
-        else:
+            if question.mode == "meaning":
+                print("the other matches were: {}".format(", ".join(grade.unmatched)))
+        elif question.mode == "multiple choice":
             print(
-                f"Incorrect. The answer was:\n\t{correct_number_val}) {answer_func(card)}"
+                "Incorrect. The answer was:\n\t"
+                f"{question.answer_index + 1}) {question.answer}"
             )
-        return is_correct
-
-    def _quiz_say_upright_question(self):
-        """return correct if the user is able to say the upright meaning of the card"""
-        card = self._draw()
-        print(
-            f"Please say atleast 2 things the following card represents, comma separated.\n\t{card.name}\n"
-        )
-
-        # print(card.upright)
-        user_input = input()
-        user_input_things = user_input.split(",")
-        things_cards_means = card.upright.split(",")
-
-        matches_to_score = 2
-        current_matches = 0
-        match_fuzz_threshold = 0.55
-        for thing in user_input_things:
-            rmv_answer = ""
-            for card_meaning in things_cards_means:
-                if fuzzy_string_comparison(thing, card_meaning) > match_fuzz_threshold:
-                    current_matches += 1
-                    things_cards_means.remove(card_meaning)
-            if rmv_answer:
-                things_cards_means.remove(rmv_answer)
-        is_correct = current_matches >= matches_to_score
-        if not is_correct:
-
-            print(f"Incorrect. The answer was:\n\t{card.upright}")
-            print(f"you had {current_matches} matches")
         else:
-            print("Correct!")
-            print("the other matches were: {}".format(", ".join(things_cards_means)))
-        return is_correct
-
-    def _quiz_get_name(self, card):
-        "get name of card"
-        return card.name
-
-    def _quiz_get_name_normalized(self, card):
-        "get name of card"
-        return normalize_string(card.name.replace("The ", " "))
-
-    def _quiz_get_upright(self, card):
-        "get upright reading"
-        return card.upright
+            print(f"Incorrect. The answer was:\n\t{question.answer}")
+            if question.mode == "meaning":
+                print(f"you had {grade.matches} matches")
+        return grade.is_correct
 
-    def _quiz_get_number(self, card):
-        "get number of card"
-        return card.number
-
-    def _quiz_get_num_input(self):
+    def _quiz_get_num_input(self, num_choices=4):
         "get input from user"
         value = None
         while value is None:
             _value = input("> ")
-            if _value.isnumeric() and int(_value) in range(0, 5):
+            if _value.isdecimal() and int(_value) in range(1, num_choices + 1):
                 value = int(_value)
         return value
 
@@ -273,44 +785,25 @@ class TarotRunner:
                 value = _value
         return value
 
-    def _quiz_blank_entry_question(self, question_func, answer_func):
-        card = self._draw()
-        print(question_func(card))
-        answer = self._quiz_get_str_input()
-        correct_value = answer_func(card)
-
-        is_correct = self.fuzzy_comparison_threshold < self._quiz_fuzzy_compare(
-            answer, correct_value
-        )
-        if is_correct:
-            print("Correct!")
-        else:
-            print(f"Incorrect. The answer was:\n\t{answer_func(card)}")
-        return is_correct
-
-    def _quiz_fuzzy_compare(self, *args, **kwargs):
-        return fuzzy_string_comparison(*args, **kwargs)
-
     def _get_by_int(self, i):
-        if i > 22 or i < 0:
+        card = get_card_index().get_by_number(i)
+        if card is None:
             print("Card number must be between 0 and 21")
-        for card in CARDS.values():
-            if card.number == i:
-                return card
+        return card
 
     def _get_by_name(self, name):
-        for card in CARDS.values():
-            if name.lower() in card.name.lower():
-                return card
-        else:
+        candidates = get_card_index().lookup(name)
+        if not candidates:
             print(f"Card {name} not found")
             return None
+        if len(candidates) > 1 and candidates[0][1] < 1.0:
+            others = ", ".join(card.name for card, _ in candidates[1:])
+            print(f"{name} could also be: {others}")
+        return candidates[0][0]
 
     def draw(self):
         card = self.deck.draw()
-        name = card.name
-        reading = card.upright if not card.is_reverse else card.reversed
-        return f"{name} ({card.number})\n\t{reading}"
+        return f"{card.name} ({card.number})\n\t{card.reading}"
 
     def _draw(self):
         return self.deck.draw()
@@ -319,9 +812,13 @@ class TarotRunner:
         return [self._draw() for _ in range(3)]
 
     def _print_card_info(self, card):
+        import pprint
+
         pprint.pprint(card.get_dict(), sort_dicts=False)
 
     def _draw_card_text(self, card):
+        from rich.text import Text
+
         text = Text()
         text.append(card.name, style="bold")
         rev_text = " (reversed)" if card.is_reverse else ""
@@ -333,6 +830,36 @@ class TarotRunner:
         return text
 
 
+def startup_benchmark(runs=20, args=("--info", "5")):
+    """time running this script in fresh interpreters, against python doing nothing
+    the first run starts without a snapshot so it also shows the cost of building one
+    """
+
+    import subprocess
+
+    def run_times(command, num_runs):
+        times = []
+        for _ in range(num_runs):
+            start = time.perf_counter()
+            subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+        return times
+
+    script = [sys.executable, __file__, *args]
+    for snapshot_path in _snapshot_dir.glob("*.marshal"):
+        snapshot_path.unlink()
+    results = {
+        "python -c pass": run_times([sys.executable, "-c", "pass"], runs),
+        "no snapshot": run_times(script, 1),
+        "with snapshot": run_times(script, runs),
+    }
+    for name, times in results.items():
+        print(
+            f"{name:>15}: min {min(times) * 1000:6.1f}ms"
+            f"  mean {sum(times) / len(times) * 1000:6.1f}ms"
+        )
+
+
 if __name__ == "__main__":
     # TarotRunner().quiz_main()
     # quit()
@@ -341,26 +868,101 @@ if __name__ == "__main__":
     args.add_argument("-r", "--reading", action="store_true", default=False)
     args.add_argument("-d", "--draw", type=int, nargs="*", default=None)
     args.add_argument("-q", "--quiz", type=int, nargs="*", default=1)
+    args.add_argument("-s", "--seed", type=int, default=None, help="seed the shuffle")
+    args.add_argument(
+        "--quiz-batch",
+        type=str,
+        default=None,
+        metavar="FILE",
+        help="grade answers from a file, - for stdin, results are printed as json lines",
+    )
+    args.add_argument(
+        "--quiz-bench",
+        type=int,
+        nargs="?",
+        const=100_000,
+        default=None,
+        metavar="QUESTIONS",
+        help="time making and grading this many quiz questions (default 100000)",
+    )
+    args.add_argument(
+        "-m",
+        "--simulate",
+        type=int,
+        default=None,
+        metavar="SPREADS",
+        help="deal this many spreads and compare the frequencies with the exact odds",
+    )
+    args.add_argument(
+        "--spread", type=int, default=3, help="cards per spread with --simulate"
+    )
+    args.add_argument(
+        "--card", type=str, default=None, help="card to single out with --simulate"
+    )
+    args.add_argument(
+        "-w", "--workers", type=int, default=1, help="processes used by --simulate"
+    )
+    args.add_argument(
+        "--bench-startup",
+        type=int,
+        nargs="?",
+        const=20,
+        default=None,
+        metavar="RUNS",
+        help="time how long `tarot.py --info 5` takes to start",
+    )
     args.add_argument("args", nargs="*")
     args = args.parse_args()
 
     # if q isn't there ignore default arg
     is_quiz = "-q" in sys.argv or "--quiz" in sys.argv
 
+    if args.bench_startup:
+        startup_benchmark(args.bench_startup)
+        quit(0)
+
+    if args.quiz_bench:
+        QuizEngine(seed=args.seed).benchmark(args.quiz_bench)
+        quit(0)
+
+    if args.quiz_batch:
+        engine = QuizEngine(seed=args.seed)
+        num_correct = num_graded = 0
+        answers = sys.stdin if args.quiz_batch == "-" else open(args.quiz_batch)
+        with answers:
+            for question, answer, grade in engine.grade_stream(answers):
+                num_graded += 1
+                num_correct += grade.is_correct
+                result = {"question": question.get_dict(), "answer": answer.get_dict()}
+                result.update(grade.get_dict())
+                print(json.dumps(result))
+        print(f"{num_correct} out of {num_graded} correct", file=sys.stderr)
+        quit(0)
+
+    if args.simulate:
+        simulator = SpreadSimulator(spread_size=args.spread, seed=args.seed)
+        start = time.perf_counter()
+        counts = simulator.simulate(args.simulate, workers=args.workers)
+        elapsed = time.perf_counter() - start
+        card = get_card_index().get(args.card) if args.card else None
+        simulator.report(counts, card)
+        print(f"{args.simulate / elapsed:,.0f} spreads/s")
+        quit(0)
+
     print("\n")
     if is_quiz:
         # print("q")
-        TarotRunner().quiz_main(*args.quiz)
+        TarotRunner(args.seed).quiz_main(*args.quiz)
     elif args.info:
         # print("info\n")
         TarotRunner().info_main(*args.info)
     elif args.reading:
         # print("reading\n")
-        TarotRunner().reading_main()
+        TarotRunner(args.seed).reading_main()
     elif args.draw:
         # print("draw {} cards\n".format(args.draw))
-        runner = TarotRunner()
-        for _ in range(args.draw):
+        runner = TarotRunner(args.seed)
+        for _ in range(args.draw[0]):
             print(runner.draw())
     else:
-        print(TarotRunner().draw())
+        print(TarotRunner(args.seed).draw())